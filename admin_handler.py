@@ -0,0 +1,48 @@
+"""Handlers for administrators
+
+The URLs below /admin/ are restricted to admins in app.yaml.
+
+Classes:
+PasswordHashBenchmarkHandler -- Benchmark and calibrate password hashing.
+RateLimitStatsHandler -- Show the limits and the rejected requests.
+"""
+
+import password_hashing
+import rate_limit
+from handler import Handler
+
+
+class PasswordHashBenchmarkHandler(Handler):
+    def get(self):
+        # Run on the instance, so the numbers fit the production instances.
+        # /admin/pw_hash_benchmark?target_ms=100
+        try:
+            target_ms = float(self.request.get('target_ms', 100))
+        except ValueError:
+            target_ms = 100
+        hasher = password_hashing.DEFAULT_HASHER
+        hashes_per_second = password_hashing.benchmark(hasher)
+        iterations = password_hashing.calibrate(target_ms)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.write('Hasher: %s, %d iterations\n' 
+                   % (hasher.name, hasher.iterations))
+        self.write('Hashes per second per core: %.1f\n' % hashes_per_second)
+        self.write('Milliseconds per hash: %.1f\n' 
+                   % (1000.0 / hashes_per_second))
+        self.write('Iterations for %.0f ms per hash: %d\n' 
+                   % (target_ms, iterations))
+        self.write('Set PBKDF2_ITERATIONS in password_hashing.py to change '
+                   'the work factor.\n')
+
+
+class RateLimitStatsHandler(Handler):
+    def get(self):
+        # /admin/rate_limits
+        counts = rate_limit.rejection_counts()
+        self.response.headers['Content-Type'] = 'text/plain'
+        for (route, scope), count in sorted(counts.iteritems()):
+            limit = rate_limit.ROUTE_LIMITS[route][scope]
+            self.write('%s per %s: %d requests per %d s, %d rejected\n'
+                       % (route, scope, limit.capacity, limit.period, count))
+
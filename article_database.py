@@ -2,15 +2,49 @@
 
 Classes:
 Article -- Model for the Blog articles
+ArticleSummary -- Model for the summaries of the Blog articles
 Comment -- Model for Comments 
 """
 
 import logging
+import datetime
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 
 from utils import *
+from cache import CacheNamespace
+from tracing import traced
+import search_database
+import counter_database
+
+
+# Increase the version after changing the model to orphan the cached
+# Article-objects of the old version.
+ARTICLE_CACHE = CacheNamespace('Article', 2, local_size = 200, local_ttl = 60)
+
+ARTICLE_SUMMARY_CACHE = CacheNamespace('ArticleSummary', 2)
+
+# Rendered homepage (see HomePageHandler).
+# It is flushed whenever an article is created, edited or removed.
+HOMEPAGE_CACHE = CacheNamespace('homepage', 1)
+
+# Time of the last change of an article, see Article.last_change().
+SITE_CACHE = CacheNamespace('site', 1)
+
+# Number of articles of every author, see ArticleSummary.count_by_author().
+# It is flushed together with the homepage.
+AUTHOR_CACHE = CacheNamespace('author', 1)
+
+# Compressed Atom and RSS feeds (see FeedHandler).
+# They are flushed together with the homepage.
+FEED_CACHE = CacheNamespace('feed', 1, local_size = 4, local_ttl = 60)
+
+# Number of characters of the article body shown in list views.
+EXCERPT_LENGTH = 300
+
+# Maximum number of keys of one batched datastore delete.
+DELETE_BATCH_SIZE = 500
 
 
 class Article(db.Model):
@@ -18,15 +52,26 @@ class Article(db.Model):
 
     Methods:
     by_id -- Return an Article-object for a given article-id.
-    remove -- 
+    by_ids -- Return a list of Article-objects for a list of article-ids.
+    recent -- Return a list of the most recent Article-objects.
+    page -- Return a page of the most recent Article-objects and a cursor.
+    update_article_cache -- Store an Article-object in memcache.
+    flush_homepage_cache -- Delete the rendered homepage from memcache.
+    last_change -- Return the time of the last change of an article.
+    remove -- Delete an Article-object from the datastore.
+    remove_multi -- Delete a list of Article-objects from the datastore.
     """
 
     title = db.StringProperty(required = True)
     body = db.TextProperty(required = True)
     author = db.IntegerProperty(required = True) #user-id of author
-    created = db.DateTimeProperty(auto_now=True)
+    author_name = db.StringProperty() #username of author, see rename_author
+    # Set again when the article is edited (see EditArticleHandler), but not
+    # when background tasks update the article.
+    created = db.DateTimeProperty(auto_now_add=True)
 
     @classmethod
+    @traced('Article.by_id')
     def by_id(cls, article_id):
         """Return an Article-object for a given Article-id
 
@@ -39,13 +84,43 @@ class Article(db.Model):
         article -- the Article-object for the given article-id, None if not found
         """
 
-        key = str(article_id)
-        article = memcache.get(key)
+        article = ARTICLE_CACHE.get(article_id)
         if article is None:
             article = Article.get_by_id(int(article_id))
-            memcache.set(key, article)
+            ARTICLE_CACHE.set(article_id, article)
         return article
 
+    @classmethod
+    @traced('Article.by_ids')
+    def by_ids(cls, article_ids):
+        """Return a list of Article-objects for a list of Article-ids.
+
+        Read all articles with a single memcache multi-get. The articles 
+        that are not stored in memcache are fetched with a single batched 
+        Datastore get and written back to memcache in bulk.
+        Articles that are not found are left out of the list.
+        Argument:
+        article_ids -- list of Article-ids
+        Return value:
+        article_list -- list of Article-objects in the order of article_ids
+        """
+
+        article_ids = [int(article_id) for article_id in article_ids]
+        cached = ARTICLE_CACHE.get_multi(article_ids)
+        missing = [article_id for article_id in article_ids
+                   if cached.get(article_id) is None]
+        if missing:
+            fetched = Article.get_by_id(missing)
+            fill = {}
+            for article_id, article in zip(missing, fetched):
+                if article is not None:
+                    cached[article_id] = article
+                    fill[article_id] = article
+            if fill:
+                ARTICLE_CACHE.set_multi(fill)
+        return [cached[article_id] for article_id in article_ids
+                if cached.get(article_id) is not None]
+
     @classmethod
     def update_article_cache(cls, article):
         """Store an Article-object in memcache.
@@ -55,8 +130,40 @@ class Article(db.Model):
         article -- the Article-object to be stored in memcache
         """
 
-        key = str(article.key().id())
-        memcache.set(key, article)
+        ARTICLE_CACHE.update(article.key().id(), article)
+        cls.flush_homepage_cache()
+
+    @classmethod
+    def flush_homepage_cache(cls):
+        """Delete the rendered homepage from memcache.
+
+        Must be called after every change that is visible on the homepage.
+        Also deletes the feeds and the article counts of the author pages
+        and sets the time returned by last_change().
+        """
+
+        HOMEPAGE_CACHE.flush()
+        AUTHOR_CACHE.flush()
+        FEED_CACHE.flush()
+        SITE_CACHE.set('last_change', 
+                       datetime.datetime.utcnow().replace(microsecond = 0))
+
+    @classmethod
+    def last_change(cls):
+        """Return the time of the last change of an article.
+
+        The time is read from memcache. If it was evicted, the current 
+        time is stored and returned, so pages look changed rather than 
+        unchanged.
+        Return value:
+        the UTC time of the last change [datetime]
+        """
+
+        last_change = SITE_CACHE.get('last_change')
+        if last_change is None:
+            last_change = datetime.datetime.utcnow().replace(microsecond = 0)
+            SITE_CACHE.set('last_change', last_change)
+        return last_change
 
     @classmethod
     def keys_by_author(cls, author):
@@ -77,24 +184,24 @@ class Article(db.Model):
     def by_author(cls, author):
         """Return a list of Article-objects for a given author-id.
 
-        Create a list of article-keys by calling the keys_by_author() method..
-        Create a list of article-objects by calling the by_id() method for
-        every key.
+        Create a list of article-keys by calling the keys_by_author() method.
+        Fetch the articles with the batched by_ids() method.
 
         Argument:
         author -- the user-id of the author
         Return value:
-        article_list -- list of Article-objects for the given author
+        article_list -- list of Article-objects for the given author, 
+        most recent first
         Returns an empty list if no entity is found.
         """
         key_list = cls.keys_by_author(author)
-        article_list = []
-        for key in key_list:
-            article = cls.by_id(key.id())
-            article_list.append(article)
+        article_list = cls.by_ids([key.id() for key in key_list])
+        article_list.sort(key = lambda article: article.created, 
+                          reverse = True)
         return article_list
 
     @classmethod
+    @traced('Article.recent')
     def recent(cls, number):
         """Return a list of the most recent Article-objects.
 
@@ -104,16 +211,38 @@ class Article(db.Model):
         article_list -- list of Article-objectsr
         Returns an empty list if no entity is found.
         """
-        key_list = Article.all(keys_only=True).order('-created')
-        article_list = []
-        for key in key_list.run(limit = int(number)):
-            article = cls.by_id(key.id())
-            article_list.append(article)
+        article_list, cursor = cls.page(number)
         return article_list
 
+    @classmethod
+    @traced('Article.page')
+    def page(cls, number, cursor = None):
+        """Return a page of the most recent Article-objects and a cursor.
+
+        Execute a keys-only query starting at the given Datastore cursor
+        and fetch the articles with by_ids().
+        Arguments:
+        number -- the number of articles on the page
+        cursor -- the cursor returned for the previous page, 
+        None for the first page
+        Return value:
+        (article_list, next_cursor) -- list of Article-objects and the 
+        cursor of the next page, next_cursor is None on the last page
+        Raises BadRequestError or BadValueError for an invalid cursor.
+        """
+        number = int(number)
+        query = Article.all(keys_only=True).order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        article_ids = [key.id() for key in query.fetch(number)]
+        next_cursor = None
+        if len(article_ids) == number:
+            next_cursor = query.cursor()
+        return cls.by_ids(article_ids), next_cursor
+
 
     @classmethod
-    def create(cls, title, body, author):
+    def create(cls, title, body, author, author_name):
         """Return a new Article-object to store in the datastore.
 
         Construct and return a new Article-object with the given arguments.
@@ -121,28 +250,223 @@ class Article(db.Model):
         title -- the title of the article
         body -- the body of the article
         author -- the user-id of the author of the article
+        author_name -- the username of the author of the article
         Return value:
         article -- the new Article-object
         """
 
         return Article(title = title,
                        body = body,
-                       author = author)
+                       author = author,
+                       author_name = author_name)
 
    
     @classmethod
     def remove(cls, article_id):
         """Delete an Article-object from the datastore.
 
-        Delete Article-object from datastore and memcache.
+        Delete Article-object, its ArticleSummary-object and its view 
+        counter from datastore and memcache and remove the article from 
+        the search index.
         Argument:
         article_id -- Article-id
         """
-        article = Article.by_id(int(article_id))
-        db.delete(article)
+        cls.remove_multi([article_id])
+
+    @classmethod
+    def remove_multi(cls, article_ids):
+        """Delete a list of Article-objects from the datastore.
+
+        Delete the Article-objects, their ArticleSummary-objects and their
+        view counters from the datastore with batched deletes of at most 
+        DELETE_BATCH_SIZE keys, and from memcache with one batched delete.
+        Remove the articles from the search index.
+        The Article-objects are deleted last, so the articles of a failed
+        call are found and removed again by a retry.
+        Argument:
+        article_ids -- list of Article-ids
+        """
+        article_ids = [int(article_id) for article_id in article_ids]
+        keys = (counter_database.shard_keys(article_ids) +
+                [db.Key.from_path('ArticleSummary', article_id)
+                 for article_id in article_ids] +
+                [db.Key.from_path('Article', article_id)
+                 for article_id in article_ids])
+        for i in xrange(0, len(keys), DELETE_BATCH_SIZE):
+            db.delete(keys[i:i + DELETE_BATCH_SIZE])
+
+        ARTICLE_CACHE.delete_multi(article_ids)
+        ARTICLE_SUMMARY_CACHE.delete_multi(article_ids)
+        counter_database.VIEW_CACHE.delete_multi(article_ids)
+        search_database.unindex_articles(article_ids)
+        cls.flush_homepage_cache()
+
+
+class ArticleSummary(db.Model):
+    """Datastore model for the summaries of the Blog articles
+
+    An ArticleSummary has the same id as its Article. It holds everything
+    list views need, so they do not have to load the article body.
+    Every put() of an Article must be followed by ArticleSummary.update().
+    Methods:
+    update -- Store the summary of an Article-object.
+    by_ids -- Return a list of ArticleSummary-objects for a list of ids.
+    page -- Return a page of the most recent ArticleSummary-objects.
+    page_by_author -- Return a page of the most recent summaries of an author.
+    count_by_author -- Return the number of articles of an author.
+    """
+
+    title = db.StringProperty(required = True)
+    author = db.IntegerProperty(required = True) #user-id of author
+    author_name = db.StringProperty() #username of author
+    created = db.DateTimeProperty(required = True) #created of the Article
+    excerpt = db.TextProperty(required = True)
+    body_length = db.IntegerProperty(required = True, indexed = False)
+
+    @classmethod
+    def from_article(cls, article):
+        """Return a new ArticleSummary-object for an Article-object.
+
+        Argument:
+        article -- a stored Article-object
+        Return value:
+        the new ArticleSummary-object
+        """
+
+        body = article.body
+        excerpt = body
+        if len(body) > EXCERPT_LENGTH:
+            # Cut at the last space to not break words.
+            excerpt = body[:EXCERPT_LENGTH]
+            if ' ' in excerpt:
+                excerpt = excerpt.rsplit(' ', 1)[0]
+            excerpt = excerpt + '...'
+        return ArticleSummary(key = db.Key.from_path('ArticleSummary', 
+                                                     article.key().id()),
+                              title = article.title,
+                              author = article.author,
+                              author_name = article.author_name,
+                              created = article.created,
+                              excerpt = excerpt,
+                              body_length = len(body))
+
+    @classmethod
+    def update(cls, article):
+        """Store the summary of an Article-object in datastore and memcache.
+
+        Argument:
+        article -- a stored Article-object
+        Return value:
+        summary -- the ArticleSummary-object
+        """
 
-        key = str(article_id)
-        memcache.delete(key)
+        summary = cls.from_article(article)
+        summary.put()
+        ARTICLE_SUMMARY_CACHE.set(article.key().id(), summary)
+        return summary
+
+    @classmethod
+    @traced('ArticleSummary.by_ids')
+    def by_ids(cls, article_ids):
+        """Return a list of ArticleSummary-objects for a list of Article-ids.
+
+        Read with a single memcache multi-get, fetch the missing summaries
+        with a single batched Datastore get and write them back to 
+        memcache in bulk.
+        Argument:
+        article_ids -- list of Article-ids
+        Return value:
+        summary_list -- list of ArticleSummary-objects in the order of 
+        article_ids, summaries that are not found are left out
+        """
+
+        article_ids = [int(article_id) for article_id in article_ids]
+        cached = ARTICLE_SUMMARY_CACHE.get_multi(article_ids)
+        missing = [article_id for article_id in article_ids
+                   if cached.get(article_id) is None]
+        if missing:
+            fetched = ArticleSummary.get_by_id(missing)
+            fill = {}
+            for article_id, summary in zip(missing, fetched):
+                if summary is not None:
+                    cached[article_id] = summary
+                    fill[article_id] = summary
+            if fill:
+                ARTICLE_SUMMARY_CACHE.set_multi(fill)
+        return [cached[article_id] for article_id in article_ids
+                if cached.get(article_id) is not None]
+
+    @classmethod
+    @traced('ArticleSummary.page')
+    def page(cls, number, cursor = None):
+        """Return a page of the most recent ArticleSummary-objects.
+
+        Arguments:
+        number -- the number of summaries on the page
+        cursor -- the cursor returned for the previous page, 
+        None for the first page
+        Return value:
+        (summary_list, next_cursor) -- list of ArticleSummary-objects and
+        the cursor of the next page, next_cursor is None on the last page
+        Raises BadRequestError or BadValueError for an invalid cursor.
+        """
+        number = int(number)
+        query = ArticleSummary.all(keys_only=True).order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        article_ids = [key.id() for key in query.fetch(number)]
+        next_cursor = None
+        if len(article_ids) == number:
+            next_cursor = query.cursor()
+        return cls.by_ids(article_ids), next_cursor
+
+    @classmethod
+    @traced('ArticleSummary.page_by_author')
+    def page_by_author(cls, author, number, cursor = None):
+        """Return a page of the most recent ArticleSummary-objects of an author.
+
+        The keys-only query runs on the index (author, -created), see 
+        index.yaml, the summaries are read with the batched by_ids().
+        Arguments:
+        author -- the user-id of the author
+        number -- the number of summaries on the page
+        cursor -- the cursor returned for the previous page, 
+        None for the first page
+        Return value:
+        (summary_list, next_cursor) -- list of ArticleSummary-objects and
+        the cursor of the next page, next_cursor is None on the last page
+        Raises BadRequestError or BadValueError for an invalid cursor.
+        """
+        number = int(number)
+        query = ArticleSummary.all(keys_only=True)\
+                              .filter('author', int(author))\
+                              .order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        article_ids = [key.id() for key in query.fetch(number)]
+        next_cursor = None
+        if len(article_ids) == number:
+            next_cursor = query.cursor()
+        return cls.by_ids(article_ids), next_cursor
+
+    @classmethod
+    def count_by_author(cls, author):
+        """Return the number of articles of an author.
+
+        Read first from memcache. Count with a keys-only query and update
+        memcache if the count is not cached.
+        Argument:
+        author -- the user-id of the author
+        Return value:
+        the number of articles [int]
+        """
+        author = int(author)
+        count = AUTHOR_CACHE.get(author)
+        if count is None:
+            count = ArticleSummary.all(keys_only=True)\
+                                  .filter('author', author).count(None)
+            AUTHOR_CACHE.set(author, count)
+        return count
 
 
 class DeletdArticle(db.Model):
@@ -151,6 +475,7 @@ class DeletdArticle(db.Model):
     The stored entities represent deleted articles.
     Methods:
     create -- Return a new DeletdArticle-object.
+    from_article -- Return a new DeletdArticle-object for an Article-object.
     """
 
     title = db.StringProperty(required = True)
@@ -174,4 +499,21 @@ class DeletdArticle(db.Model):
 
         return DeletdArticle(title = title, body = body, author = int(author))
 
+    @classmethod
+    def from_article(cls, article):
+        """Return a new DeletdArticle-object for an Article-object.
+
+        The key name is the Article-id, so archiving an article twice 
+        (e.g. when a task is retried) overwrites the first copy.
+        Argument:
+        article -- the Article-object
+        Return value:
+        the new DeletdArticle-object
+        """
+
+        return DeletdArticle(key_name = str(article.key().id()),
+                             title = article.title, 
+                             body = article.body, 
+                             author = article.author)
+
 
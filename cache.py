@@ -0,0 +1,385 @@
+"""Namespaced and versioned access to memcache
+
+Every kind of cached object gets its own CacheNamespace. The memcache
+namespace of a CacheNamespace is built from its name, its schema version
+and a generation number:
+
+    <name>.v<version>.g<generation>
+
+So equal ids of different models never overwrite each other.
+Increasing the schema version (e.g. after a model changes) orphans all
+old entries of the namespace at once without a memcache flush.
+The generation number is stored in memcache and incremented by flush()
+to invalidate all entries of a namespace at runtime.
+
+A CacheNamespace can have a LocalCache in front of memcache: a bounded
+LRU cache with a TTL in the memory of the instance. update() and delete()
+increment a stamp counter in memcache and store the changed keys under
+the new stamp. When an instance reads a newer stamp, it reads the keys
+of the stamps it missed and drops only their LocalCache entries, so a
+change on one instance invalidates that key on every instance and the
+other entries stay. If a change record is missing (evicted, or the stamp
+jumped), the whole LocalCache is cleared. flush() clears it as well.
+
+Classes:
+LocalCache -- in-process LRU cache with TTL and hit/miss counters
+CacheNamespace -- memcache access for one kind of cached object
+
+Functions:
+local_stats -- Return the counters of all LocalCache-objects.
+"""
+
+import time
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+
+# Memcache namespace where the generation numbers and stamps are stored.
+GENERATION_NAMESPACE = 'cache_generations'
+
+# Seconds generation number and stamp are kept in the instance memory
+# before they are read again from memcache. A change on another instance
+# becomes visible after at most this time. The instance that makes the
+# change sees it at once.
+GENERATION_CACHE_TIME = 5
+
+# Seconds a record of changed keys is kept in memcache, longer than
+# GENERATION_CACHE_TIME, so instances find the records they missed.
+CHANGE_RECORD_TIME = 120
+# An instance that missed more stamps clears its LocalCache instead of
+# reading the change records.
+MAX_CHANGE_RECORDS = 50
+# Number of recently changed keys an instance remembers, see
+# CacheNamespace._local_set().
+MAX_CHANGED_KEYS = 1000
+
+# All CacheNamespace-objects that have a LocalCache, see local_stats().
+_local_namespaces = []
+
+
+class LocalCache(object):
+    """In-process LRU cache with TTL and hit/miss counters
+
+    The values are stored pickled, so every get() returns a new object
+    and requests can not change each other's objects.
+    Methods:
+    get -- Return the value stored for a key.
+    set -- Store a value for a key.
+    delete -- Delete a key.
+    clear -- Delete all keys.
+    stats -- Return the hit/miss counters.
+    """
+
+    def __init__(self, size, ttl):
+        """Arguments:
+        size -- maximum number of entries [integer]
+        ttl -- seconds until an entry expires [number]
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for key, None if not found.
+
+        An entry older than ttl is not found.
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            # Move the entry to the end (most recently used).
+            self._entries[key] = entry
+            self.hits += 1
+        return pickle.loads(entry[0])
+
+    def set(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (data, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary with the counters and the number of entries."""
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries)}
+
+
+class CacheNamespace(object):
+    """Memcache access for one kind of cached object
+
+    All keys are converted to strings, so ids can be passed as integers.
+    Use set() to fill the cache after a read and update() after a write.
+    Methods:
+    namespace -- Return the current memcache namespace.
+    get -- Return the cached value for a key.
+    get_multi -- Return a dictionary of cached values for a list of keys.
+    set -- Store a value.
+    set_multi -- Store a dictionary of values.
+    update -- Store a changed value and invalidate the LocalCaches.
+    delete -- Delete a key and invalidate the LocalCaches.
+    delete_multi -- Delete a list of keys and invalidate the LocalCaches.
+    flush -- Invalidate all entries of the namespace.
+    """
+
+    def __init__(self, name, version, local_size = 0, local_ttl = 60):
+        """Arguments:
+        name -- name of the namespace, usually the model name [string]
+        version -- schema version of the cached objects [integer]
+        local_size -- maximum number of entries in the LocalCache,
+        0 for no LocalCache [integer]
+        local_ttl -- seconds until an entry of the LocalCache expires
+        """
+
+        self.name = name
+        self.version = version
+        self.generation_key = '%s.v%d' % (name, version)
+        self.stamp_key = '%s.v%d.stamp' % (name, version)
+        self.local = None
+        if local_size:
+            self.local = LocalCache(local_size, local_ttl)
+            _local_namespaces.append(self)
+        self._state = None
+        self._state_read = 0
+        # Stamp of the last change of recently changed keys.
+        self._changed = OrderedDict()
+        # Stamp at which the LocalCache was last cleared.
+        self._cleared = 0
+        self._lock = threading.Lock()
+
+    def _read_counter(self, key, counters):
+        """Return a counter from counters or create it in memcache.
+
+        If the counter is missing (never set or evicted), a new one is
+        created from the current time, so entries of an evicted
+        generation or stamp can not become valid again.
+        """
+
+        value = counters.get(key)
+        if value is None:
+            value = int(time.time() * 1000)
+            if not memcache.add(key, value, namespace = GENERATION_NAMESPACE):
+                # Another request was faster.
+                value = memcache.get(key, namespace = GENERATION_NAMESPACE)\
+                        or value
+        return value
+
+    def _read_state(self):
+        """Return (generation, stamp) as stored in memcache."""
+
+        counters = memcache.get_multi([self.generation_key, self.stamp_key],
+                                      namespace = GENERATION_NAMESPACE)
+        return (self._read_counter(self.generation_key, counters),
+                self._read_counter(self.stamp_key, counters))
+
+    def _state_now(self):
+        """Return (generation, stamp), read from memcache if outdated."""
+
+        with self._lock:
+            if (self._state is None or
+                time.time() - self._state_read > GENERATION_CACHE_TIME):
+                self._set_state(self._read_state())
+            return self._state
+
+    def _set_state(self, state):
+        """Apply a new (generation, stamp) to the LocalCache.
+
+        Called with _lock held. Drop the LocalCache entries of the keys
+        changed since the previous stamp, or all entries if the
+        generation changed or a change record is missing.
+        """
+
+        previous = self._state
+        self._state = state
+        self._state_read = time.time()
+        if not self.local or previous is None:
+            return
+        if previous[0] != state[0]:
+            self._clear_local()
+            return
+        missed = state[1] - previous[1]
+        if missed <= 0:
+            return
+        records = None
+        if missed <= MAX_CHANGE_RECORDS:
+            record_keys = [self._change_key(stamp) for stamp 
+                           in range(previous[1] + 1, state[1] + 1)]
+            records = memcache.get_multi(record_keys, 
+                                         namespace = GENERATION_NAMESPACE)
+            if len(records) < len(record_keys):
+                records = None
+        if records is None:
+            self._clear_local()
+            return
+        for record_key, keys in records.iteritems():
+            stamp = int(record_key.rsplit('.', 1)[1])
+            for key in keys:
+                self.local.delete(key)
+                self._changed.pop(key, None)
+                self._changed[key] = stamp
+        while len(self._changed) > MAX_CHANGED_KEYS:
+            self._changed.popitem(last = False)
+
+    def _clear_local(self):
+        # Called with _lock held. Values read before are not stored.
+        self.local.clear()
+        self._changed.clear()
+        self._cleared = self._state[1]
+
+    def _change_key(self, stamp):
+        return '%s.%d' % (self.stamp_key, stamp)
+
+    def _record_change(self, keys):
+        """Increment the stamp and store the changed keys under it."""
+
+        stamp = memcache.incr(self.stamp_key, namespace = GENERATION_NAMESPACE)
+        if stamp is not None:
+            memcache.set(self._change_key(stamp), keys, CHANGE_RECORD_TIME,
+                         namespace = GENERATION_NAMESPACE)
+        # If the stamp was missing, _read_state() creates a new one and
+        # all instances clear their LocalCache.
+        with self._lock:
+            self._set_state(self._read_state())
+            return self._state
+
+    def _local_set(self, key, value, state):
+        """Store a value read from memcache at state in the LocalCache.
+
+        The value is not stored if the key changed or the LocalCache was 
+        cleared since state, it may be outdated.
+        """
+
+        with self._lock:
+            if (self._state[0] != state[0] or
+                self._changed.get(key, 0) > state[1] or
+                self._cleared > state[1]):
+                return
+            self.local.set(key, value)
+
+    def namespace(self):
+        """Return the current memcache namespace of this CacheNamespace."""
+
+        return '%s.g%d' % (self.generation_key, self._state_now()[0])
+
+    def get(self, key):
+        if self.local:
+            state = self._state_now()
+            value = self.local.get(str(key))
+            if value is None:
+                value = memcache.get(str(key), namespace = self.namespace())
+                if value is not None:
+                    self._local_set(str(key), value, state)
+            return value
+        return memcache.get(str(key), namespace = self.namespace())
+
+    def get_multi(self, keys):
+        """Return a dictionary {key: value} of the cached values.
+
+        The returned dictionary uses the given keys, not the strings they
+        are stored under. Keys that are not cached are left out.
+        """
+
+        keys = list(keys)
+        result = {}
+        if self.local:
+            state = self._state_now()
+            for key in keys:
+                value = self.local.get(str(key))
+                if value is not None:
+                    result[key] = value
+            keys = [key for key in keys if key not in result]
+        if keys:
+            cached = memcache.get_multi([str(key) for key in keys],
+                                        namespace = self.namespace())
+            for key in keys:
+                if str(key) in cached:
+                    result[key] = cached[str(key)]
+                    if self.local and cached[str(key)] is not None:
+                        self._local_set(str(key), cached[str(key)], state)
+        return result
+
+    def set(self, key, value, cache_time = 0):
+        if self.local and value is not None:
+            self._local_set(str(key), value, self._state_now())
+        return memcache.set(str(key), value, cache_time,
+                            namespace = self.namespace())
+
+    def set_multi(self, mapping, cache_time = 0):
+        if self.local:
+            state = self._state_now()
+            for key, value in mapping.iteritems():
+                if value is not None:
+                    self._local_set(str(key), value, state)
+        return memcache.set_multi(
+            dict((str(key), value) for key, value in mapping.iteritems()),
+            cache_time, namespace = self.namespace())
+
+    def update(self, key, value, cache_time = 0):
+        """Store a changed value.
+
+        Memcache is updated at once. The LocalCache entries of the key 
+        on all instances are invalidated by a change record.
+        """
+
+        memcache.set(str(key), value, cache_time, 
+                     namespace = self.namespace())
+        if self.local:
+            self._record_change([str(key)])
+            self.local.set(str(key), value)
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        keys = [str(key) for key in keys]
+        memcache.delete_multi(keys, namespace = self.namespace())
+        if self.local:
+            self._record_change(keys)
+
+    def flush(self):
+        """Invalidate all entries of this namespace.
+
+        Increment the generation number, the old entries are no longer
+        read and expire from memcache over time.
+        """
+
+        memcache.incr(self.generation_key, namespace = GENERATION_NAMESPACE)
+        # If the counter is missing, _read_state() creates a new one.
+        with self._lock:
+            self._set_state(self._read_state())
+
+
+def local_stats():
+    """Return the counters of all LocalCache-objects.
+
+    Return value:
+    dictionary {namespace name: LocalCache.stats()}
+    """
+
+    return dict((namespace.name, namespace.local.stats())
+                for namespace in _local_namespaces)
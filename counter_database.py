@@ -0,0 +1,192 @@
+"""Sharded view counters of the articles
+
+A page view only increments a counter in memcache. The counter is split
+into BUFFER_SHARDS memcache keys, so a hot article does not hit a single
+key. The first view of an article in every FLUSH_INTERVAL schedules a
+named task (one per article and interval) that moves the buffered views
+into one of the NUM_SHARDS ViewCounterShard-entities of the article.
+So the datastore gets at most one write per article and interval, no
+matter how many views there are, and the writes of different intervals
+go to different entities.
+
+The total is the sum of the shards. It is read with one batched get of
+the shard keys and cached for FLUSH_INTERVAL seconds.
+Views that are still buffered when memcache evicts the buffer are lost,
+the counts are meant for statistics, not for accounting.
+
+Classes:
+ViewCounterShard -- Model for the shards of the view counters
+
+Functions:
+record_view -- Count a view of an article.
+flush_views -- Move the buffered views of an article to the datastore.
+view_count -- Return the number of views of an article.
+view_counts -- Return the number of views of a list of articles.
+shard_keys -- Return the keys of the shards of a list of articles.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from cache import CacheNamespace
+
+
+# Sums of the shards, see view_counts(). They expire after FLUSH_INTERVAL
+# instead of being deleted by every flush, so the sums of hot articles
+# are read from the memory of the instance.
+VIEW_CACHE = CacheNamespace('views', 1, local_size = 1000, local_ttl = 10)
+
+# Memcache namespace of the buffered views.
+BUFFER_NAMESPACE = 'view_buffer'
+# Number of memcache keys a buffer is split into.
+BUFFER_SHARDS = 10
+# Number of ViewCounterShard-entities per article.
+NUM_SHARDS = 20
+# Seconds between two flushes of the views of an article.
+FLUSH_INTERVAL = 10
+# Task queue of the flush tasks, see queue.yaml.
+FLUSH_QUEUE = 'counters'
+
+# Articles that got a flush task from this instance in the current
+# interval, so the instance adds at most one task per article and
+# interval. The task names take care of the other instances. Guarded by
+# _scheduled_lock, requests run in parallel threads (threadsafe: yes).
+_scheduled = {'interval': None, 'article_ids': set()}
+_scheduled_lock = threading.Lock()
+
+
+class ViewCounterShard(db.Model):
+    """Datastore model for the shards of the view counters
+
+    The key name is '<Article-id>:<shard>', so the shards of an article
+    are read by key, without a query.
+    """
+
+    count = db.IntegerProperty(default = 0, indexed = False)
+
+
+def shard_keys(article_ids):
+    """Return the keys of the shards of a list of Article-ids."""
+    return [db.Key.from_path('ViewCounterShard',
+                             '%d:%d' % (int(article_id), shard))
+            for article_id in article_ids for shard in range(NUM_SHARDS)]
+
+
+def _buffer_keys(article_id):
+    return ['%d:%d' % (int(article_id), shard)
+            for shard in range(BUFFER_SHARDS)]
+
+
+def record_view(article_id):
+    """Count a view of an article.
+
+    Increment a random memcache key of the buffer and schedule the flush
+    of the current interval. Costs one memcache RPC, plus one task queue
+    RPC for the first view of the article in the interval on an instance.
+    Argument:
+    article_id -- Article-id
+    """
+    article_id = int(article_id)
+    key = '%d:%d' % (article_id, random.randint(0, BUFFER_SHARDS - 1))
+    memcache.incr(key, namespace = BUFFER_NAMESPACE, initial_value = 0)
+
+    interval = int(time.time() / FLUSH_INTERVAL)
+    with _scheduled_lock:
+        if _scheduled['interval'] != interval:
+            _scheduled['interval'] = interval
+            _scheduled['article_ids'] = set()
+        if article_id in _scheduled['article_ids']:
+            return
+        _scheduled['article_ids'].add(article_id)
+    try:
+        deferred.defer(flush_views, article_id,
+                       _name = 'views-%d-%d' % (article_id, interval),
+                       _countdown = FLUSH_INTERVAL,
+                       _queue = FLUSH_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        # Another instance was faster.
+        pass
+    except taskqueue.Error:
+        # The views stay in the buffer for the next flush.
+        logging.warning('Could not schedule the view flush of article %d.'
+                        % article_id)
+
+
+def flush_views(article_id):
+    """Move the buffered views of an article to the datastore.
+
+    Read all memcache keys of the buffer, subtract the read values, so
+    views counted in the meantime stay in the buffer, and add the sum
+    to a random shard in a transaction.
+    Argument:
+    article_id -- Article-id
+    """
+    keys = _buffer_keys(article_id)
+    buffered = memcache.get_multi(keys, namespace = BUFFER_NAMESPACE)
+    taken = {}
+    for key, value in buffered.iteritems():
+        value = int(value)
+        if value > 0:
+            memcache.decr(key, value, namespace = BUFFER_NAMESPACE)
+            taken[key] = value
+    total = sum(taken.values())
+    if not total:
+        return
+
+    def add_to_shard(key):
+        shard = ViewCounterShard.get(key)
+        if shard is None:
+            shard = ViewCounterShard(key = key)
+        shard.count += total
+        shard.put()
+
+    key = random.choice(shard_keys([article_id]))
+    try:
+        db.run_in_transaction(add_to_shard, key)
+    except Exception:
+        # Put the views back, the task is retried.
+        memcache.offset_multi(taken, namespace = BUFFER_NAMESPACE,
+                              initial_value = 0)
+        raise
+
+
+def view_counts(article_ids):
+    """Return the number of views of a list of articles.
+
+    Read the cached sums with one memcache multi-get. The shards of the
+    other articles are read with one batched datastore get, their sums
+    are written back to memcache in bulk.
+    Views that are not flushed yet are not counted.
+    Argument:
+    article_ids -- list of Article-ids
+    Return value:
+    dictionary {Article-id: number of views}
+    """
+    article_ids = [int(article_id) for article_id in article_ids]
+    counts = VIEW_CACHE.get_multi(article_ids)
+    missing = [article_id for article_id in article_ids
+               if counts.get(article_id) is None]
+    if missing:
+        shards = db.get(shard_keys(missing))
+        fill = {}
+        for i, article_id in enumerate(missing):
+            fill[article_id] = sum(shard.count for shard
+                                   in shards[i * NUM_SHARDS:
+                                             (i + 1) * NUM_SHARDS]
+                                   if shard is not None)
+        VIEW_CACHE.set_multi(fill, FLUSH_INTERVAL)
+        counts.update(fill)
+    return counts
+
+
+def view_count(article_id):
+    """Return the number of views of an article, see view_counts()."""
+    return view_counts([article_id])[int(article_id)]
@@ -0,0 +1,149 @@
+"""Atom and RSS feeds of the most recent articles
+
+A feed document is rendered once, gzip compressed and stored in memcache
+together with its ETag. It does not expire, it is flushed with the homepage
+whenever an article is created, edited or removed (see
+Article.flush_homepage_cache()), so serving a feed costs one cache read.
+The links in a feed use the canonical host of the application, not the
+host of the request, so all hosts share one cached document.
+
+Classes:
+FeedHandler -- Base class of the feed handlers.
+AtomFeedHandler -- /feed.atom
+RssFeedHandler -- /feed.rss
+
+Functions:
+canonical_host_url -- Return scheme and host of the links in the feeds.
+rfc3339 -- Format a time for Atom.
+rfc822 -- Format a time for RSS.
+"""
+
+import os
+import zlib
+import hashlib
+import calendar
+from email.utils import formatdate
+
+from google.appengine.api import app_identity
+
+from handler import Handler, DEV_SERVER
+from article_database import Article, ArticleSummary, FEED_CACHE
+
+# Number of articles in a feed.
+FEED_SIZE = 20
+
+# Seconds feed readers and proxies may cache a feed without asking again.
+FEED_MAX_AGE = 300
+
+
+class FeedHandler(Handler):
+    """Base class of the feed handlers
+
+    Subclasses set the template, the content type and time_format, the
+    function that formats a datetime (UTC) for the feed.
+    Methods:
+    get -- Serve the cached feed, build it if it is not cached.
+    build_feed -- Render and compress the feed document.
+    """
+
+    template = None
+    content_type = None
+    time_format = None
+
+    def get(self):
+        feed = FEED_CACHE.get(self.template)
+        if feed is None:
+            feed = self.build_feed(canonical_host_url())
+            FEED_CACHE.set(self.template, feed)
+
+        # The feed is the same for all users, the cookie does not matter.
+        self.response.headers['Content-Type'] = self.content_type
+        self.response.headers['ETag'] = '"%s"' % feed['etag']
+        self.response.headers['Cache-Control'] = ('public, max-age=%d'
+                                                  % FEED_MAX_AGE)
+        self.response.last_modified = feed['last_modified']
+        self.add_vary('Accept-Encoding')
+
+        if self.request.headers.get('If-None-Match'):
+            matched = self.match_etag(feed['etag'])
+            modified = matched is None
+            if matched:
+                self.response.headers['ETag'] = '"%s"' % matched
+        elif self.request.if_modified_since:
+            modified = (feed['last_modified'] >
+                        self.request.if_modified_since.replace(tzinfo = None))
+        else:
+            modified = True
+        if not modified:
+            self.response.status = 304
+            return
+
+        if 'gzip' in self.request.accept_encoding:
+            self.write(feed['gzip'])
+            self.set_gzip_encoding()
+        else:
+            self.write(zlib.decompress(feed['gzip'], 16 + zlib.MAX_WBITS))
+
+    def build_feed(self, host_url):
+        '''Render the feed document and compress it.
+
+        Argument:
+        host_url -- scheme and host of the links in the feed
+        Return value:
+        dictionary with the compressed document 'gzip', its 'etag' and
+        the time of its last change 'last_modified' (UTC)
+        '''
+        last_modified = Article.last_change()
+        article_list, next_cursor = ArticleSummary.page(FEED_SIZE)
+        for article in article_list:
+            article.time = self.time_format(article.created)
+            if not article.author_name:
+                article.author_name = 'Unknown'
+        xml = self.render_str(self.template,
+                              host_url = host_url,
+                              updated = self.time_format(last_modified),
+                              article_list = article_list).encode('utf-8')
+        # The document is compressed once per change of the articles,
+        # so use the best compression.
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(xml) + compressor.flush()
+        return {'gzip': data,
+                'etag': hashlib.md5(xml).hexdigest(),
+                'last_modified': last_modified}
+
+
+def canonical_host_url():
+    """Return scheme and host of the links in the feeds.
+
+    The environment variable CANONICAL_HOST_URL (see app.yaml), else the
+    default hostname of the application.
+    """
+    url = os.environ.get('CANONICAL_HOST_URL')
+    if url:
+        return url.rstrip('/')
+    hostname = app_identity.get_default_version_hostname()
+    if DEV_SERVER:
+        return 'http://' + hostname
+    return 'https://' + hostname
+
+
+def rfc3339(time):
+    """Return a datetime (UTC) in the format of RFC 3339 (Atom)."""
+    return time.replace(microsecond = 0).isoformat() + 'Z'
+
+
+def rfc822(time):
+    """Return a datetime (UTC) in the format of RFC 822 (RSS)."""
+    return formatdate(calendar.timegm(time.utctimetuple()), usegmt = True)
+
+
+class AtomFeedHandler(FeedHandler):
+    template = 'feed_atom.xml'
+    content_type = 'application/atom+xml; charset=utf-8'
+    time_format = staticmethod(rfc3339)
+
+
+class RssFeedHandler(FeedHandler):
+    template = 'feed_rss.xml'
+    content_type = 'application/rss+xml; charset=utf-8'
+    time_format = staticmethod(rfc822)
@@ -2,19 +2,153 @@ import webapp2
 from webapp2_extras import sessions
 import jinja2
 import os
+import json
+import time
+import zlib
+import hashlib
 import logging
+import datetime
 
 from utils import *
 from user_database import User
+import mail_queue
+import rate_limit
+import metrics
+import tracing
 
 from google.appengine.api import mail
-
-# Create an instance of the Jinja2.environment class to
-# load the templates from the filesystem.
-# Use the Jinja2 builtin FileSystemLoader().
+from google.appengine.api import memcache
+
+# Create an instance of the Jinja2.environment class to load the templates.
+# In production the templates are loaded from the modules precompiled by
+# tools/compile_templates.py with the Jinja2 builtin ModuleLoader(), 
+# so a new instance does not have to parse and compile them.
+# If there are no precompiled templates, if they were compiled by another
+# Jinja2 version or for another app version (see compiled_templates_valid()),
+# or on the development server, load the templates from the filesystem 
+# with the FileSystemLoader(). 
+# Only the development server checks the files for changes.
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_environment = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                                       autoescape = True)
+compiled_template_dir = os.path.join(os.path.dirname(__file__), 
+                                     'compiled_templates')
+DEV_SERVER = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+def compiled_templates_valid():
+    """Return True if the precompiled templates match Jinja2 and the app.
+
+    Read the manifest written by tools/compile_templates.py and compare the
+    Jinja2 version and the app version with the running ones. The template
+    files are not read.
+    """
+    if not os.path.isdir(compiled_template_dir):
+        return False
+    try:
+        with open(os.path.join(compiled_template_dir, 
+                               TEMPLATE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        logging.warning('The precompiled templates have no manifest.')
+        return False
+    if manifest.get('jinja2_version') != jinja2.__version__:
+        logging.warning('The templates were precompiled with Jinja2 %s, '
+                        'the app runs Jinja2 %s.'
+                        % (manifest.get('jinja2_version'), 
+                           jinja2.__version__))
+        return False
+    # CURRENT_VERSION_ID is '<app version>.<deployment id>'.
+    version = os.environ.get('CURRENT_VERSION_ID', '').split('.')[0]
+    if manifest.get('app_version') != version:
+        logging.warning('The templates were precompiled for version %s, '
+                        'the app runs version %s.'
+                        % (manifest.get('app_version'), version))
+        return False
+    return True
+
+
+if not DEV_SERVER and compiled_templates_valid():
+    jinja_environment = jinja2.Environment(
+        loader = jinja2.ModuleLoader(compiled_template_dir),
+        autoescape = True,
+        auto_reload = False)
+elif DEV_SERVER:
+    jinja_environment = jinja2.Environment(
+        loader = jinja2.FileSystemLoader(template_dir),
+        autoescape = True)
+else:
+    # Share the compiled templates between instances through memcache.
+    jinja_environment = jinja2.Environment(
+        loader = jinja2.FileSystemLoader(template_dir),
+        autoescape = True,
+        auto_reload = False,
+        bytecode_cache = jinja2.MemcachedBytecodeCache(
+            memcache.Client(),
+            prefix = 'jinja2/%s/' % os.environ.get('CURRENT_VERSION_ID', '')))
+
+
+# Responses are gzip compressed if the client accepts it and they have at
+# least GZIP_MIN_SIZE bytes, see Handler.write_chunks().
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Added to the ETag of a gzip compressed body, so the compressed and the
+# uncompressed body of a page have different strong validators.
+GZIP_ETAG_SUFFIX = '-gz'
+
+# Versions of the template files, see Handler.template_version().
+_template_versions = {}
+
+
+# Seconds until a session cookie expires.
+SESSION_TIME = 7 * 24 * 3600
+
+
+class SessionClaims(object):
+    '''The claims of a signed session cookie
+
+    A SessionClaims-object has the attribute name like a User-object, 
+    so it can be passed as user to templates that only show the navbar.
+    Attributes:
+    uid -- User-id [integer]
+    name -- username [string]
+    version -- session version of the user when the session was created
+    expires -- expiry time in seconds since the epoch [integer]
+    '''
+
+    def __init__(self, uid, name, version, expires):
+        self.uid = uid
+        self.name = name
+        self.version = version
+        self.expires = expires
+
+    @classmethod
+    def for_user(cls, user):
+        '''Return new SessionClaims for a User-object.'''
+        return cls(user.key().id(), user.name, user.session_version or 0,
+                   int(time.time()) + SESSION_TIME)
+
+    @classmethod
+    def parse(cls, val):
+        '''Return the SessionClaims for a cookie value, None if invalid.
+
+        Argument:
+        val -- the value returned by to_val() [string]
+        '''
+        try:
+            uid, version, expires, name = val.split(':', 3)
+            return cls(int(uid), name, int(version), int(expires))
+        except ValueError:
+            return None
+
+    def to_val(self):
+        '''Return the claims as cookie value.
+
+        Usernames can not contain ':' or '|' (see valid_username()).
+        '''
+        return '%d:%d:%d:%s' % (self.uid, self.version, self.expires, 
+                                self.name)
+
+    def expired(self):
+        return self.expires < time.time()
 
 
 # The following Handler-class will be inherited 
@@ -44,20 +178,105 @@ class Handler(webapp2.RequestHandler):
         Return value:
         the redered template
         '''
-        template_params = params
-        t = jinja_environment.get_template(template)
-        return t.render(template_params)
+        start = time.time()
+        with tracing.span('render_str', 'render', template = template):
+            template_params = params
+            t = jinja_environment.get_template(template)
+            html = t.render(template_params)
+        metrics.record_render(time.time() - start)
+        return html
 
     def render(self, template, **kw):
         '''Create a response-body 
 
-        Render a given template and write the result to the 
-        response body.
+        Render a given template piece by piece with the generate() method
+        and write the pieces to the response body with write_chunks(),
+        which compresses them. The python27 runtime sends the response
+        only after the handler returned, the pieces are not streamed.
         Arguments:
         template -- name of the template-file
         **kw -- the variables to be passed to the renderer
         '''
-        self.write(self.render_str(template, **kw))
+        start = time.time()
+        with tracing.span('render', 'render', template = template):
+            t = jinja_environment.get_template(template)
+            self.write_chunks(t.generate(kw))
+        # Includes compressing the response, the template is rendered
+        # while it is written to the response body.
+        metrics.record_render(time.time() - start)
+
+    def write_chunks(self, chunks):
+        '''Write strings to the response body, gzip compressed if possible
+
+        If the client accepts gzip, the chunks are buffered until they
+        have GZIP_MIN_SIZE bytes. Then the response is compressed, the
+        buffer and every following chunk are written compressed.
+        Smaller responses are written uncompressed.
+        The gzip headers are set after the whole body was written, so an
+        error page that replaces a partly written body is not marked gzip.
+        Arguments:
+        chunks -- iterable of strings (unicode or utf-8)
+        '''
+        self.add_vary('Accept-Encoding')
+        if 'gzip' not in self.request.accept_encoding:
+            for chunk in chunks:
+                self.write(chunk)
+            return
+
+        buffered = []
+        size = 0
+        compressor = None
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if compressor:
+                self.write(compressor.compress(chunk))
+                continue
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= GZIP_MIN_SIZE:
+                # wbits 16 + MAX_WBITS: gzip header and trailer
+                compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                self.write(compressor.compress(''.join(buffered)))
+        if compressor:
+            self.write(compressor.flush())
+            self.set_gzip_encoding()
+        else:
+            self.write(''.join(buffered))
+
+    def set_gzip_encoding(self):
+        '''Mark the response body as gzip compressed.
+
+        Set the Content-Encoding and add GZIP_ETAG_SUFFIX to the ETag.
+        '''
+        self.response.headers['Content-Encoding'] = 'gzip'
+        etag = self.response.headers.get('ETag')
+        if etag and not etag.endswith(GZIP_ETAG_SUFFIX + '"'):
+            self.response.headers['ETag'] = '%s%s"' % (etag[:-1], 
+                                                       GZIP_ETAG_SUFFIX)
+
+    def match_etag(self, etag):
+        '''Return the tag of If-None-Match that matches an ETag.
+
+        The tag of the compressed body (see set_gzip_encoding()) matches 
+        as well.
+        Argument:
+        etag -- the ETag of the uncompressed body, without quotes
+        Return value:
+        the matching tag without quotes, None if no tag matches
+        '''
+        for tag in (etag + GZIP_ETAG_SUFFIX, etag):
+            if tag in self.request.if_none_match:
+                return tag
+
+    def add_vary(self, field):
+        '''Add a request header field to the Vary header of the response.'''
+        vary = self.response.headers.get('Vary')
+        if not vary:
+            self.response.headers['Vary'] = field
+        elif field not in vary:
+            self.response.headers['Vary'] = '%s, %s' % (vary, field)
 
 
 # --- COOKIE HANDLING ---
@@ -96,13 +315,120 @@ class Handler(webapp2.RequestHandler):
         # y is evaluated and the resulting value is returned.
 
 
+# --- CONDITIONAL GET ---
+
+    def template_version(self, *templates):
+        '''Return the version of template files.
+
+        The version is a hash of the content of the files and their last
+        modification time. It is computed once per instance.
+        Arguments:
+        *templates -- names of the template files, including the templates
+        they extend
+        Return value:
+        (version, last_modified) -- [string], [datetime]
+        '''
+        if templates not in _template_versions:
+            h = hashlib.md5()
+            mtime = 0
+            for template in templates:
+                path = os.path.join(template_dir, template)
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+                mtime = max(mtime, os.path.getmtime(path))
+            _template_versions[templates] = (
+                h.hexdigest(), datetime.datetime.utcfromtimestamp(int(mtime)))
+        return _template_versions[templates]
+
+    def not_modified(self, version, last_modified, max_age = 0):
+        '''Set the caching headers and check if the client copy is current.
+
+        The ETag is made from the content version and the session, because
+        the navbar shows the username.
+        If the request has a matching If-None-Match (or, without 
+        If-None-Match, an If-Modified-Since not older than last_modified),
+        set the status 304. The handler must then not render the page.
+        A 304 has the ETag the client sent, see match_etag().
+        Arguments:
+        version -- version of the content of the page [string]
+        last_modified -- time of the last change of the content, UTC
+        max_age -- seconds the page may be cached without revalidation
+        Return value:
+        True if the status was set to 304, False otherwise.
+        '''
+        if self.claims:
+            session = '%d:%d:%s' % (self.claims.uid, self.claims.version, 
+                                    self.claims.name)
+            cache_control = 'private, max-age=%d' % max_age
+        else:
+            session = 'anonymous'
+            cache_control = 'public, max-age=%d' % max_age
+        etag = hashlib.md5('%s|%s' % (version, session)).hexdigest()
+
+        self.response.headers['ETag'] = '"%s"' % etag
+        self.response.headers['Cache-Control'] = cache_control
+        self.add_vary('Cookie')
+        self.add_vary('Accept-Encoding')
+        self.response.last_modified = last_modified
+
+        if self.request.headers.get('If-None-Match'):
+            matched = self.match_etag(etag)
+            modified = matched is None
+            if matched:
+                self.response.headers['ETag'] = '"%s"' % matched
+        elif self.request.if_modified_since:
+            modified = (last_modified > 
+                        self.request.if_modified_since.replace(tzinfo = None))
+        else:
+            modified = True
+        if not modified:
+            self.response.status = 304
+        return not modified
+
+
 # --- LOGIN, LOGOUT ---
 
     def login(self, user):
-        self.set_secure_cookie('user_id', str(user.key().id()))
+        '''Set a session cookie for a User-object.
+
+        Call login() again after the session version of the logged in user 
+        was incremented, to keep the current session valid.
+        '''
+        self.claims = SessionClaims.for_user(user)
+        self.set_secure_cookie('session', self.claims.to_val())
 
     def logout(self):
-        self.response.headers.add_header('Set-Cookie', 'user_id=; Path=/')
+        self.response.headers.add_header('Set-Cookie', 'session=; Path=/')
+
+    def read_session(self):
+        '''Return the SessionClaims of the session cookie.
+
+        Return None if there is no cookie or if it is not correctly signed,
+        expired or does not match the current session version of the user.
+        Only the session version is looked up, not the User-object.
+        '''
+        val = self.read_secure_cookie('session')
+        claims = val and SessionClaims.parse(val)
+        if not claims or claims.expired():
+            return None
+        if claims.version != User.session_version_by_id(claims.uid):
+            return None
+        return claims
+
+    @property
+    def user(self):
+        '''The User-object of the logged in user, None if not logged in.
+
+        It is loaded on first access, so handlers that only need the 
+        username should use self.claims.
+        '''
+        if not hasattr(self, '_user'):
+            self._user = self.claims and User.by_id(self.claims.uid)
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
 
 
 # --- SECURITY AGAINST CSRF ---
@@ -139,15 +465,44 @@ class Handler(webapp2.RequestHandler):
             return False
 
 
+# --- RATE LIMITING ---
+
+    def rate_limited(self, route, email = None):
+        '''Take a token of the rate limits of a route, reject if there is none.
+
+        Must be called before any expensive work of the request.
+        If the request is rejected, the status 429 and a message page are 
+        set, the handler must then return.
+        Arguments:
+        route -- name of the route in rate_limit.ROUTE_LIMITS
+        email -- email address the request is about, None if there is none
+        Return value:
+        True if the request was rejected, False otherwise.
+        '''
+        if rate_limit.allow(route, 
+                            ip = self.request.remote_addr, 
+                            email = email):
+            return False
+        limits = rate_limit.ROUTE_LIMITS[route].values()
+        self.response.headers['Retry-After'] = str(
+            int(max(1.0 / limit.rate for limit in limits)))
+        self.response.status = 429
+        self.render('message.html', 
+                    user = self.claims, 
+                    message_rate_limit_1 = True)
+        return True
+
+
 # --- INITIALIZE ---
 
     def initialize(self, *a, **kw):
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        uid = self.read_secure_cookie('user_id')
-        self.user = uid and User.by_id(int(uid))
+        self.outbox = []
+        self.claims = self.read_session()
         # Initialize() is called after every request.
-        # self.user is either set to None (if there is no user_id-cookie)
-        # or to the entity returned from the Datastore (possibly None)
+        # self.claims is either set to None (if there is no valid session)
+        # or to the SessionClaims of the session cookie.
+        # self.user is loaded from the Datastore on first access.
 
 # --- EMAIL HANDLING ---
 
@@ -156,7 +511,8 @@ class Handler(webapp2.RequestHandler):
 
         Check if the given email address is valid.
         If not valid, log warning.
-        If valid, send email.
+        If valid, render the email and add it to the outbox. The outbox is
+        enqueued at the end of the request and sent in the background.
         Arguments:
         to_address -- receiver email address
         subject_template -- name of template file for the email subject
@@ -171,7 +527,32 @@ class Handler(webapp2.RequestHandler):
             sender_address = "Blog <blog@gmail.com>"
             body = self.render_str(email_template, **kw)
             subject = self.render_str(subject_template, **kw)
-            mail.send_mail(sender_address, to_address, subject, body)
+            self.outbox.append(mail_queue.message(sender_address, to_address,
+                                                  subject, body))
+
+    def send_email_to_admins(self, sender_address, subject, body):
+        '''Send an email to the administrators of the app
+
+        Add the email to the outbox, see send_email().
+        '''
+        self.outbox.append(mail_queue.message(sender_address, None,
+                                              subject, body, 
+                                              to_admins = True))
+
+    def dispatch(self):
+        '''Dispatch the request and enqueue the emails of the outbox.
+
+        Trace the request if it is sampled, see tracing.start().
+        '''
+        trace = tracing.start(self.request)
+        if trace:
+            self.response.headers['X-Trace-Id'] = str(trace.id)
+        try:
+            webapp2.RequestHandler.dispatch(self)
+        finally:
+            mail_queue.enqueue(self.outbox)
+            self.outbox = []
+            tracing.finish(self.response.status_int)
 
 #--- EXCEPTIONS ---
 
@@ -181,6 +562,12 @@ class Handler(webapp2.RequestHandler):
         else:
             logging.exception(exception)
             self.error(500)
+            # The headers of the page that failed do not describe the
+            # error page.
+            for header in ('Content-Encoding', 'ETag', 'Last-Modified',
+                           'Cache-Control'):
+                if header in self.response.headers:
+                    del self.response.headers[header]
             self.render('error.html')
 
 
@@ -1,32 +1,266 @@
 import time
+import urllib
+import datetime
 import logging
 
 from handler import Handler
 
 from google.appengine.api import mail
+from google.appengine.ext import db
+from jinja2 import Markup
 
 from utils import *
-from article_database import Article
+from article_database import Article, ArticleSummary, HOMEPAGE_CACHE,\
+                             EXCERPT_LENGTH
 from user_database import User
+from search_database import defer_index_article, search
+from counter_database import record_view, view_count
+
+# Seconds until a rendered homepage expires from memcache, even if it was
+# not invalidated by a change of an article.
+HOMEPAGE_CACHE_TIME = 600
+
+# Number of articles on a homepage page: default and maximum for the
+# parameter n.
+HOMEPAGE_PAGE_SIZE = 20
+HOMEPAGE_MAX_PAGE_SIZE = 50
+
+# Seconds browsers and proxies may cache the about, terms and privacy pages
+# without asking again.
+STATIC_PAGE_MAX_AGE = 3600
+
+
+def quote_cursor(cursor):
+    """Return a datastore cursor encoded for a URL parameter.
+
+    Cursors are URL-safe base64 only in some SDK versions, so quote all
+    reserved characters, e.g. '+', '/' and '='.
+    """
+    return cursor and urllib.quote(cursor, safe = '')
+
+
+# Number of results on a search page.
+SEARCH_PAGE_SIZE = 10
 
 class HomePageHandler(Handler):
     def get(self):
-        article_list = Article.recent(100)
-        for article in article_list:
-            t = article.created.isoformat()
-            article.time = t
+        # Get page size and cursor from URL: /?cursor=...&n=...
+        try:
+            n = int(self.request.get('n', HOMEPAGE_PAGE_SIZE))
+        except ValueError:
+            n = HOMEPAGE_PAGE_SIZE
+        n = max(1, min(n, HOMEPAGE_MAX_PAGE_SIZE))
+        cursor = self.request.get('cursor') or None
+
+        # Answer with 304 if no article was changed since the last visit.
+        last_change = Article.last_change()
+        version = '%s|%d|%s' % (last_change.isoformat(), n, cursor)
+        if self.not_modified(version, last_change):
+            return
+
+        try:
+            if not self.claims and not cursor:
+                # Anonymous visitors get the cached first page as it is.
+                key = 'html:%d' % n
+                html = HOMEPAGE_CACHE.get(key)
+                if html is None:
+                    html = self.render_str('homepage.html',
+                                           articles_html = self.articles_html(n))
+                    HOMEPAGE_CACHE.set(key, html, HOMEPAGE_CACHE_TIME)
+                self.write_chunks([html])
+            else:
+                self.render('homepage.html',
+                            user = self.claims,
+                            articles_html = self.articles_html(n, cursor, 
+                                                               self.claims))
+        except (db.BadRequestError, db.BadValueError):
+            # Invalid cursor
+            self.redirect('/')
+
+    def articles_html(self, n, cursor = None, user = None):
+        '''Return the rendered article list of a homepage page.
+
+        The article list is rendered without user specific parts.
+        The first page (no cursor) is cached in memcache together with 
+        the author of every article.
+        If a user is given, the edit button is filled in for the 
+        articles of this user.
+        Arguments:
+        n -- number of articles on the page
+        cursor -- Datastore cursor of the page, None for the first page
+        user -- the SessionClaims of the logged in user or None
+        Return value:
+        the rendered article list [Markup]
+        '''
+        key = 'articles:%d' % n
+        cached = None
+        if not cursor:
+            cached = HOMEPAGE_CACHE.get(key)
+        if cached is None:
+            # List views only read the summaries, not the full articles.
+            article_list, next_cursor = ArticleSummary.page(n, cursor)
+            for article in article_list:
+                t = article.created.isoformat()
+                article.time = t
+            # Articles stored before the author name was added to them
+            # need a (batched) lookup of the author.
+            legacy_list = [article for article in article_list
+                           if not article.author_name]
+            if legacy_list:
+                authors = User.by_ids([article.author 
+                                       for article in legacy_list])
+                for article in legacy_list:
+                    author = authors.get(article.author)
+                    if author:
+                        article.author_name = author.name
+                    else:
+                        article.author_name = 'Unknown'
+            cached = {'html': self.render_str('homepage_articles.html',
+                                              article_list = article_list,
+                                              next_cursor = quote_cursor(next_cursor),
+                                              n = n,
+                                              excerpt_length = EXCERPT_LENGTH),
+                      'authors': [(article.key().id(), article.author)
+                                  for article in article_list]}
+            if not cursor:
+                HOMEPAGE_CACHE.set(key, cached, HOMEPAGE_CACHE_TIME)
+
+        html = cached['html']
+        if user:
+            uid = user.uid
+            for article_id, author in cached['authors']:
+                if author == uid:
+                    html = html.replace(
+                        '<!--edit_article:%s-->' % article_id,
+                        self.render_str('edit_button.html', 
+                                        article_id = article_id))
+        return Markup(html)
+
+
+class ArticleHandler(Handler):
+    def get(self):
+        input_article_id = self.request.get('article')
+        article = None
+        if input_article_id.isdigit():
+            article = Article.by_id(input_article_id)
+        if not article:
+            self.error(404)
+            # Show message that the article does not exist.
+            self.render('message.html', 
+                        user = self.claims, 
+                        message_article_1 = True)
+            return
+
+        author_name = article.author_name
+        if not author_name:
             author = User.by_id(article.author)
             if author:
-                article.author_name = author.name
+                author_name = author.name
             else:
-                article.author_name = 'Unknown'
+                author_name = 'Unknown'
+        article_id = article.key().id()
+        record_view(article_id)
+        self.render('article.html',
+                    user = self.claims,
+                    article = article,
+                    author_name = author_name,
+                    time = article.created.isoformat(),
+                    views = view_count(article_id))
+
+
+class AuthorHandler(Handler):
+    def get(self, author_id):
+        author_id = int(author_id)
+        # Get page size and cursor from URL: /author/ID?cursor=...&n=...
+        try:
+            n = int(self.request.get('n', HOMEPAGE_PAGE_SIZE))
+        except ValueError:
+            n = HOMEPAGE_PAGE_SIZE
+        n = max(1, min(n, HOMEPAGE_MAX_PAGE_SIZE))
+        cursor = self.request.get('cursor') or None
+
+        author = User.by_id(author_id)
+        if not author:
+            self.error(404)
+            # Show message that the author does not exist.
+            self.render('message.html',
+                        user = self.claims,
+                        message_author_1 = True)
+            return
 
-        if self.user:
-            self.render('homepage.html',
-                        user = self.user, 
-                        article_list = article_list)
-        else:
-            self.render('homepage.html', article_list = article_list)
+        # Answer with 304 if no article was changed since the last visit.
+        last_change = Article.last_change()
+        version = '%s|%d|%s|%d|%s' % (last_change.isoformat(), author_id,
+                                      author.name, n, cursor)
+        if self.not_modified(version, last_change):
+            return
+
+        try:
+            article_list, next_cursor = ArticleSummary.page_by_author(
+                author_id, n, cursor)
+        except (db.BadRequestError, db.BadValueError):
+            # Invalid cursor
+            self.redirect('/author/%d' % author_id)
+            return
+        for article in article_list:
+            article.time = article.created.isoformat()
+            article.author_name = author.name
+        html = self.render_str('homepage_articles.html',
+                               article_list = article_list,
+                               next_cursor = quote_cursor(next_cursor),
+                               n = n,
+                               excerpt_length = EXCERPT_LENGTH,
+                               page_url = '/author/%d' % author_id)
+        if self.claims and self.claims.uid == author_id:
+            # All articles on the page belong to the logged in user.
+            for article in article_list:
+                article_id = article.key().id()
+                html = html.replace(
+                    '<!--edit_article:%s-->' % article_id,
+                    self.render_str('edit_button.html',
+                                    article_id = article_id))
+        self.render('author.html',
+                    user = self.claims,
+                    author_name = author.name,
+                    article_count = ArticleSummary.count_by_author(author_id),
+                    articles_html = Markup(html))
+
+
+class SearchHandler(Handler):
+    def get(self):
+        # Get query and page from URL: /search?q=...&page=...
+        query = self.request.get('q').strip()
+        try:
+            page = max(1, int(self.request.get('page', 1)))
+        except ValueError:
+            page = 1
+
+        article_list = []
+        next_page = None
+        truncated = False
+        if query:
+            # The ranked ids of hot queries come from memcache, only the
+            # summaries of the current page are loaded.
+            article_ids, truncated = search(query)
+            start = (page - 1) * SEARCH_PAGE_SIZE
+            page_ids = article_ids[start:start + SEARCH_PAGE_SIZE]
+            article_list = ArticleSummary.by_ids(page_ids)
+            for article in article_list:
+                article.time = article.created.isoformat()
+                if not article.author_name:
+                    article.author_name = 'Unknown'
+            if len(article_ids) > start + SEARCH_PAGE_SIZE:
+                next_page = page + 1
+
+        self.render('search.html',
+                    user = self.claims,
+                    query = query,
+                    query_param = urllib.quote_plus(query.encode('utf-8')),
+                    article_list = article_list,
+                    page = page,
+                    next_page = next_page,
+                    truncated = truncated,
+                    excerpt_length = EXCERPT_LENGTH)
 
 
 class NewArticleHandler(Handler):
@@ -76,8 +310,13 @@ class NewArticleHandler(Handler):
                 # Create new entry in the Article-DB.
                 article = Article.create(input_title, 
                                          input_body, 
-                                         self.user.key().id())
+                                         self.user.key().id(),
+                                         self.user.name)
                 article.put()
+                # Update the summary shown in list views
+                ArticleSummary.update(article)
+                # Update the search index in the background
+                defer_index_article(article.key().id())
                 # Update memcache
                 Article.update_article_cache(article)
                 
@@ -160,7 +399,12 @@ class EditArticleHandler(Handler):
                     # Edit article-entity and commit to Article-DB.
                     article.title = input_title
                     article.body = input_body
+                    article.created = datetime.datetime.now()
                     article.put()
+                    # Update the summary shown in list views
+                    ArticleSummary.update(article)
+                    # Update the search index in the background
+                    defer_index_article(article.key().id())
                     # Update memcache
                     Article.update_article_cache(article)
                     # Redirect to homepage
@@ -186,6 +430,9 @@ class ContactHandler(Handler):
                         state = state)
 
     def post(self):
+        # Reject floods before the email to the admins is sent.
+        if self.rate_limited('contact', email = self.request.get('email')):
+            return
         if not self.check_state():
             logging.warning("Possible CSRF attack detected!")
             self.redirect("/")
@@ -260,29 +507,41 @@ class ContactHandler(Handler):
             sender = "blog@gmail.com"
             subject = input_subject
             body = "Message from: "+input_email+" --- Content: "+input_content
-            mail.send_mail_to_admins(sender, subject, body)
+            self.send_email_to_admins(sender, subject, body)
 
 
 class AboutHandler(Handler):
     def get(self):
-        if self.user:
-            self.render('about.html', user = self.user)
+        version, last_modified = self.template_version('about.html', 
+                                                       'base.html')
+        if self.not_modified(version, last_modified, STATIC_PAGE_MAX_AGE):
+            return
+        if self.claims:
+            self.render('about.html', user = self.claims)
         else:
             self.render('about.html')
 
 
 class TermsHandler(Handler):
     def get(self):
-        if self.user:
-            self.render('terms.html', user = self.user)
+        version, last_modified = self.template_version('terms.html', 
+                                                       'base.html')
+        if self.not_modified(version, last_modified, STATIC_PAGE_MAX_AGE):
+            return
+        if self.claims:
+            self.render('terms.html', user = self.claims)
         else:
             self.render('terms.html')
 
 
 class PrivacyHandler(Handler):
     def get(self):
-        if self.user:
-            self.render('privacy.html', user = self.user)
+        version, last_modified = self.template_version('privacy.html', 
+                                                       'base.html')
+        if self.not_modified(version, last_modified, STATIC_PAGE_MAX_AGE):
+            return
+        if self.claims:
+            self.render('privacy.html', user = self.claims)
         else:
             self.render('privacy.html')
 
@@ -301,6 +560,10 @@ class SendEmailHandler(Handler):
 
 
     def post(self):
+        # Reject floods before the email is sent, limited per recipient.
+        if self.rate_limited('send_email', 
+                             email = self.request.get('email_to')):
+            return
         if self.user:
             if not self.check_state():
                 logging.warning("Possible CSRF attack detected!")
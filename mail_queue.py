@@ -0,0 +1,183 @@
+"""Asynchronous outbound email
+
+Handlers do not call the Mail API. They render the emails and add them to
+the outbox of the request (see Handler.send_email). At the end of the
+request all emails of the outbox are enqueued as one batch. A worker
+(MailWorkerHandler in tasks.py) sends the batch from the task queue 'mail'
+(see queue.yaml). Emails that fail are enqueued again with backoff.
+The worker records the emails it has sent in memcache, so a retry of the
+task does not send them again.
+
+The backend can be replaced, e.g. by a LocalBackend in tests:
+    mail_queue.set_backend(mail_queue.LocalBackend())
+
+Classes:
+TaskQueueBackend -- Enqueue batches on the task queue 'mail'.
+LocalBackend -- Keep batches in memory until drain() is called.
+
+Functions:
+message -- Return a new email message.
+enqueue -- Enqueue a batch of email messages.
+send_message -- Send one email message with the Mail API.
+send_batch -- Send a batch of email messages and retry the failed ones.
+set_backend -- Replace the backend.
+"""
+
+import json
+import logging
+
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+
+MAIL_QUEUE = 'mail'
+MAIL_WORKER_URL = '/tasks/mail'
+
+# A failed email is sent again at most MAX_ATTEMPTS times, after
+# RETRY_BACKOFF * 2^attempt seconds but at most MAX_BACKOFF seconds.
+MAX_ATTEMPTS = 8
+RETRY_BACKOFF = 10
+MAX_BACKOFF = 3600
+
+# Memcache namespace of the indexes of the sent emails of a task.
+PROGRESS_NAMESPACE = 'mail_progress'
+# Seconds the progress of a task is kept, longer than its retries take.
+PROGRESS_TIME = 24 * 3600
+
+
+def message(sender, to, subject, body, to_admins = False):
+    """Return a new email message [dictionary].
+
+    Arguments:
+    sender -- sender address
+    to -- receiver address, ignored if to_admins is True
+    subject -- subject of the email
+    body -- body of the email
+    to_admins -- True to send the email to the administrators of the app
+    """
+    return {'sender': sender,
+            'to': to,
+            'subject': subject,
+            'body': body,
+            'to_admins': to_admins}
+
+
+class TaskQueueBackend(object):
+    """Enqueue batches on the task queue 'mail'."""
+
+    def add(self, messages, attempt = 0, countdown = 0, name = None):
+        payload = json.dumps({'messages': messages, 'attempt': attempt})
+        try:
+            taskqueue.Queue(MAIL_QUEUE).add(
+                taskqueue.Task(url = MAIL_WORKER_URL,
+                               payload = payload,
+                               countdown = countdown,
+                               name = name))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # Added by a previous run of the same task.
+            pass
+
+
+class LocalBackend(object):
+    """Keep batches in memory until drain() is called.
+
+    Attributes:
+    batches -- list of (messages, attempt) of the enqueued batches
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def add(self, messages, attempt = 0, countdown = 0, name = None):
+        self.batches.append((messages, attempt))
+
+    def drain(self, send = None):
+        """Send all enqueued batches with send_batch().
+
+        Argument:
+        send -- function to send one message, see send_batch()
+        """
+        while self.batches:
+            messages, attempt = self.batches.pop(0)
+            send_batch(messages, attempt, send)
+
+
+_backend = TaskQueueBackend()
+
+
+def set_backend(backend):
+    """Replace the backend, return the previous backend."""
+    global _backend
+    previous = _backend
+    _backend = backend
+    return previous
+
+
+def enqueue(messages):
+    """Enqueue a batch of email messages.
+
+    Argument:
+    messages -- list of messages returned by message()
+    """
+    if messages:
+        _backend.add(messages)
+
+
+def send_message(msg):
+    """Send one email message with the Mail API."""
+    if msg['to_admins']:
+        mail.send_mail_to_admins(msg['sender'], msg['subject'], msg['body'])
+    else:
+        mail.send_mail(msg['sender'], msg['to'], msg['subject'], msg['body'])
+
+
+def send_batch(messages, attempt = 0, send = None, task_name = None):
+    """Send a batch of email messages and retry the failed ones.
+
+    The failed messages are enqueued again as one batch with backoff.
+    Invalid messages are not sent again.
+    With a task_name, the indexes of the sent and dropped messages are
+    recorded in memcache after every message and skipped if the task
+    runs again, e.g. because enqueueing the failed messages failed. The
+    failed messages get the task name '<task_name>-retry', so they are
+    enqueued only once.
+    Arguments:
+    messages -- list of messages returned by message()
+    attempt -- number of previous attempts of this batch
+    send -- function to send one message, default send_message()
+    task_name -- name of the task of the batch, None to send all messages
+    """
+    send = send or send_message
+    done = set()
+    if task_name:
+        done.update(memcache.get(task_name, namespace = PROGRESS_NAMESPACE)
+                    or [])
+    failed = []
+    for i, msg in enumerate(messages):
+        if i in done:
+            continue
+        try:
+            send(msg)
+        except (mail.InvalidEmailError, mail.InvalidSenderError,
+                mail.MissingBodyError, mail.MissingSubjectError):
+            logging.exception('Invalid email dropped.')
+        except Exception:
+            logging.exception('Sending email failed.')
+            failed.append(msg)
+            continue
+        if task_name:
+            done.add(i)
+            memcache.set(task_name, sorted(done), time = PROGRESS_TIME,
+                         namespace = PROGRESS_NAMESPACE)
+
+    if failed:
+        attempt += 1
+        if attempt >= MAX_ATTEMPTS:
+            logging.error('Dropped %d emails after %d attempts.'
+                          % (len(failed), attempt))
+        else:
+            countdown = min(RETRY_BACKOFF * 2 ** attempt, MAX_BACKOFF)
+            _backend.add(failed, attempt, countdown,
+                         task_name and task_name + '-retry')
@@ -0,0 +1,259 @@
+"""Request metrics in the Prometheus text format
+
+install() wraps the dispatcher of the webapp2 router, so every request is
+timed once the route is known, and adds apiproxy hooks that count the
+datastore and memcache RPCs and the memcache hits and misses of the
+request. The handlers report the time spent rendering templates with
+record_render().
+
+The metrics are kept in the memory of the instance, the updates are a few
+dictionary operations under one lock. metrics_handler.MetricsHandler
+serves them at /metrics, labeled with the instance id, so a scraper sees
+the counters of the instance that answered.
+
+Metrics:
+blog_requests_total -- requests by route, method and status
+blog_requests_in_flight -- requests being handled
+blog_request_duration_seconds -- latency histogram by route
+blog_template_render_seconds -- render time per request by route
+blog_request_datastore_rpcs -- datastore RPCs per request by route
+blog_request_memcache_calls -- memcache RPCs per request by route
+blog_memcache_keys_total -- keys read from memcache by route and result
+(hit, miss), route "other" outside of the router (e.g. deferred tasks)
+blog_local_cache_* -- counters of the in-process caches, see cache.py
+
+Classes:
+Histogram -- Histogram with labels.
+
+Functions:
+install -- Instrument a WSGIApplication.
+record_render -- Add template render time to the current request.
+exposition -- Return all metrics in the Prometheus text format.
+"""
+
+import os
+import time
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+
+import cache
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+RPC_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_lock = threading.Lock()
+# Counters of the current request of the thread.
+_current = threading.local()
+
+
+class Histogram(object):
+    """Histogram with labels
+
+    Methods:
+    observe -- Add a value.
+    lines -- Return the lines of the Prometheus text format.
+    """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # {labels: [count per bucket..., count, sum]}
+        self.values = {}
+
+    def observe(self, labels, value):
+        # Called with _lock held.
+        values = self.values.get(labels)
+        if values is None:
+            values = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                values[i] += 1
+        values[-2] += 1
+        values[-1] += value
+
+    def lines(self, extra_labels = ()):
+        # Called with _lock held.
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s histogram' % self.name
+        for labels, values in sorted(self.values.items()):
+            labels = extra_labels + labels
+            for bound, count in zip(self.buckets, values):
+                yield '%s_bucket%s %d' % (self.name,
+                                          _labels(labels + (('le', bound),)),
+                                          count)
+            yield '%s_bucket%s %d' % (self.name,
+                                      _labels(labels + (('le', '+Inf'),)),
+                                      values[-2])
+            yield '%s_count%s %d' % (self.name, _labels(labels), values[-2])
+            yield '%s_sum%s %r' % (self.name, _labels(labels),
+                                   float(values[-1]))
+
+
+REQUEST_DURATION = Histogram('blog_request_duration_seconds',
+                             'Request latency by route.', LATENCY_BUCKETS)
+RENDER_DURATION = Histogram('blog_template_render_seconds',
+                            'Template render time per request by route.',
+                            LATENCY_BUCKETS)
+DATASTORE_RPCS = Histogram('blog_request_datastore_rpcs',
+                           'Datastore RPCs per request by route.',
+                           RPC_BUCKETS)
+MEMCACHE_CALLS = Histogram('blog_request_memcache_calls',
+                           'Memcache RPCs per request by route.',
+                           RPC_BUCKETS)
+HISTOGRAMS = [REQUEST_DURATION, RENDER_DURATION, DATASTORE_RPCS,
+              MEMCACHE_CALLS]
+
+# {(route, method, status): count}
+_requests = {}
+# {(route, 'hit' or 'miss'): count}
+_memcache_keys = {}
+_in_flight = [0]
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels)
+
+
+def _route_name(request):
+    route = getattr(request, 'route', None)
+    return getattr(route, 'template', None) or 'unmatched'
+
+
+def _dispatcher(router, request, response):
+    _current.datastore = 0
+    _current.memcache = 0
+    _current.hits = 0
+    _current.misses = 0
+    _current.render = 0.0
+    _current.active = True
+    with _lock:
+        _in_flight[0] += 1
+    start = time.time()
+    status = 500
+    try:
+        rv = router.default_dispatcher(request, response)
+        status = getattr(rv, 'status_int', None) or response.status_int
+        return rv
+    except Exception, e:
+        # webapp2 turns HTTPExceptions (e.g. 404 for unknown URLs) into
+        # responses, all other exceptions become 500.
+        status = getattr(e, 'code', None) or 500
+        raise
+    finally:
+        duration = time.time() - start
+        _current.active = False
+        route = (('route', _route_name(request)),)
+        key = (route[0][1], request.method, status)
+        with _lock:
+            _in_flight[0] -= 1
+            _requests[key] = _requests.get(key, 0) + 1
+            REQUEST_DURATION.observe(route, duration)
+            RENDER_DURATION.observe(route, _current.render)
+            DATASTORE_RPCS.observe(route, _current.datastore)
+            MEMCACHE_CALLS.observe(route, _current.memcache)
+            _count_keys(route[0][1], _current.hits, _current.misses)
+
+
+def _count_keys(route, hits, misses):
+    # Called with _lock held.
+    for result, count in (('hit', hits), ('miss', misses)):
+        if count:
+            key = (route, result)
+            _memcache_keys[key] = _memcache_keys.get(key, 0) + count
+
+
+def _pre_call_hook(service, call, request, response):
+    if not getattr(_current, 'active', False):
+        return
+    if service == 'datastore_v3':
+        _current.datastore += 1
+    elif service == 'memcache':
+        _current.memcache += 1
+
+
+def _post_call_hook(service, call, request, response):
+    if call != 'Get':
+        return
+    keys = request.key_size()
+    hits = response.item_size()
+    if getattr(_current, 'active', False):
+        # Counted by route when the request is finished.
+        _current.hits += hits
+        _current.misses += keys - hits
+        return
+    with _lock:
+        _count_keys('other', hits, keys - hits)
+
+
+def install(app):
+    """Instrument a WSGIApplication.
+
+    Set the dispatcher of the router and add the apiproxy hooks.
+    Argument:
+    app -- the webapp2.WSGIApplication
+    """
+    app.router.set_dispatcher(_dispatcher)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'metrics', _pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'metrics', _post_call_hook, 'memcache')
+
+
+def record_render(seconds):
+    """Add template render time to the current request."""
+    if getattr(_current, 'active', False):
+        _current.render += seconds
+
+
+def exposition():
+    """Return all metrics in the Prometheus text format.
+
+    Return value:
+    the metrics [string]
+    """
+    instance = (('instance', os.environ.get('INSTANCE_ID', 'local')),)
+    lines = []
+    with _lock:
+        lines.append('# HELP blog_requests_total Requests by route, '
+                     'method and status.')
+        lines.append('# TYPE blog_requests_total counter')
+        for (route, method, status), count in sorted(_requests.items()):
+            lines.append('blog_requests_total%s %d' % (
+                _labels(instance + (('route', route), ('method', method),
+                                    ('status', status))), count))
+        lines.append('# HELP blog_requests_in_flight Requests being '
+                     'handled.')
+        lines.append('# TYPE blog_requests_in_flight gauge')
+        lines.append('blog_requests_in_flight%s %d' % (_labels(instance),
+                                                        _in_flight[0]))
+        lines.append('# HELP blog_memcache_keys_total Keys read from '
+                     'memcache by route and result.')
+        lines.append('# TYPE blog_memcache_keys_total counter')
+        for (route, result), count in sorted(_memcache_keys.items()):
+            lines.append('blog_memcache_keys_total%s %d' % (
+                _labels(instance + (('route', route), ('result', result))),
+                count))
+        for histogram in HISTOGRAMS:
+            for line in histogram.lines(instance):
+                lines.append(line)
+
+    stats = cache.local_stats()
+    for field in ('hits', 'misses', 'evictions'):
+        lines.append('# TYPE blog_local_cache_%s counter' % field)
+        for namespace, counters in sorted(stats.items()):
+            lines.append('blog_local_cache_%s%s %d' % (
+                field, _labels(instance + (('namespace', namespace),)),
+                counters.get(field, 0)))
+    return '\n'.join(lines) + '\n'
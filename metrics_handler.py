@@ -0,0 +1,54 @@
+"""Scrape endpoint of the request metrics
+
+/metrics is not below /admin/, so a Prometheus scraper can reach it
+without a Google login. Instead the scraper sends the shared secret of
+the environment variable METRICS_TOKEN (see app.yaml) as a bearer token:
+
+    Authorization: Bearer <METRICS_TOKEN>
+
+Without a configured token the metrics are not served at all.
+
+Classes:
+MetricsHandler -- Serve the request metrics in the Prometheus text format.
+
+Functions:
+token_matches -- Compare a token with METRICS_TOKEN in constant time.
+"""
+
+import os
+
+import metrics
+from handler import Handler
+
+
+def token_matches(token):
+    """Compare a token with METRICS_TOKEN in constant time.
+
+    Argument:
+    token -- the token sent by the client [string]
+    Return value:
+    True if METRICS_TOKEN is set and equal to token
+    """
+    expected = os.environ.get('METRICS_TOKEN', '')
+    if not expected or len(token) != len(expected):
+        return False
+    # The time does not depend on the position of the first difference.
+    result = 0
+    for a, b in zip(token, expected):
+        result |= ord(a) ^ ord(b)
+    return result == 0
+
+
+class MetricsHandler(Handler):
+    def get(self):
+        # /metrics, the metrics of the instance that answers.
+        scheme, _, token = self.request.headers.get('Authorization',
+                                                    '').partition(' ')
+        if scheme.lower() != 'bearer' or not token_matches(token.strip()):
+            self.response.set_status(401)
+            self.response.headers['WWW-Authenticate'] = 'Bearer'
+            return
+        self.response.headers['Content-Type'] = ('text/plain; '
+                                                 'version=0.0.4')
+        self.response.headers['Cache-Control'] = 'no-store'
+        self.write(metrics.exposition())
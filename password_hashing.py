@@ -0,0 +1,201 @@
+"""Pluggable password hashing
+
+A password hash names the hasher that created it and stores its
+parameters, so the work factor can be changed at any time:
+
+    pbkdf2_sha256$<iterations>$<salt>$<hash>  -- Pbkdf2Hasher
+    <salt>,<hash>                             -- LegacyHasher (single SHA-256)
+
+New hashes are created by DEFAULT_HASHER. Hashes of another hasher or with
+other parameters are upgraded on the next successful login, see
+needs_rehash() and User.login_by_email().
+
+Use calibrate() to find the number of iterations that fits a login latency
+budget and benchmark() to measure the hashes per second of one core
+(see PasswordHashBenchmarkHandler and tools/calibrate_pw_hash.py).
+
+Classes:
+LegacyHasher -- salted single SHA-256, only used to verify old hashes
+Pbkdf2Hasher -- PBKDF2-HMAC-SHA256
+
+Functions:
+make_hash -- Return a new password hash.
+verify -- Check a password against a password hash.
+needs_rehash -- Check if a password hash should be upgraded.
+benchmark -- Return the hashes per second of a hasher.
+calibrate -- Return the iterations that fit a latency budget.
+"""
+
+import hmac
+import time
+import random
+import hashlib
+import binascii
+from string import ascii_letters
+
+# Number of PBKDF2 iterations of new hashes, see calibrate().
+PBKDF2_ITERATIONS = 20000
+
+_random = random.SystemRandom()
+
+
+def make_salt(length = 16):
+    return ''.join(_random.choice(ascii_letters) for x in xrange(length))
+
+
+def _constant_time_equal(a, b):
+    # Hashes read from the Datastore are unicode, hashes are always ASCII.
+    a, b = str(a), str(b)
+    # hmac.compare_digest is new in Python 2.7.7.
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _pbkdf2_sha256(password, salt, iterations):
+    """Return the PBKDF2-HMAC-SHA256 digest (32 bytes)."""
+    # hashlib.pbkdf2_hmac is new in Python 2.7.8.
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    mac = hmac.new(password, None, hashlib.sha256)
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+    u = prf(salt + '\x00\x00\x00\x01')
+    result = int(binascii.hexlify(u), 16)
+    for i in xrange(iterations - 1):
+        u = prf(u)
+        result ^= int(binascii.hexlify(u), 16)
+    return binascii.unhexlify('%064x' % result)
+
+
+class LegacyHasher(object):
+    """Salted single SHA-256: '<salt>,<hash>'
+
+    Only used to verify the hashes created before the hashers existed.
+    """
+
+    name = 'legacy'
+
+    def matches(self, pw_hash):
+        return '$' not in pw_hash and ',' in pw_hash
+
+    def make_hash(self, login_name, pw, salt = None):
+        if not salt:
+            salt = make_salt(10)
+        h = hashlib.sha256(login_name + pw + salt).hexdigest()
+        return '%s,%s' % (salt, h)
+
+    def verify(self, login_name, pw, pw_hash):
+        salt = pw_hash.split(',')[0]
+        return _constant_time_equal(pw_hash,
+                                    self.make_hash(login_name, pw, salt))
+
+    def needs_rehash(self, pw_hash):
+        return True
+
+
+class Pbkdf2Hasher(object):
+    """PBKDF2-HMAC-SHA256: 'pbkdf2_sha256$<iterations>$<salt>$<hash>'
+
+    The login name is part of the hashed password, like in the legacy
+    hashes, so a hash is only valid together with its login name.
+    """
+
+    name = 'pbkdf2_sha256'
+
+    def __init__(self, iterations = PBKDF2_ITERATIONS):
+        self.iterations = iterations
+
+    def matches(self, pw_hash):
+        return pw_hash.startswith(self.name + '$')
+
+    def make_hash(self, login_name, pw, salt = None, iterations = None):
+        if not salt:
+            salt = make_salt()
+        iterations = iterations or self.iterations
+        salt = str(salt)
+        password = (login_name + pw).encode('utf-8')
+        h = _pbkdf2_sha256(password, salt, iterations)
+        return '%s$%d$%s$%s' % (self.name, iterations, salt,
+                                binascii.hexlify(h))
+
+    def verify(self, login_name, pw, pw_hash):
+        try:
+            name, iterations, salt, h = pw_hash.split('$')
+            iterations = int(iterations)
+        except ValueError:
+            return False
+        return _constant_time_equal(
+            pw_hash, self.make_hash(login_name, pw, salt, iterations))
+
+    def needs_rehash(self, pw_hash):
+        return int(pw_hash.split('$')[1]) != self.iterations
+
+
+DEFAULT_HASHER = Pbkdf2Hasher()
+HASHERS = [DEFAULT_HASHER, LegacyHasher()]
+
+
+def _hasher_for(pw_hash):
+    for hasher in HASHERS:
+        if hasher.matches(pw_hash):
+            return hasher
+
+
+def make_hash(login_name, pw):
+    """Return a new password hash created by DEFAULT_HASHER."""
+    return DEFAULT_HASHER.make_hash(login_name, pw)
+
+
+def verify(login_name, pw, pw_hash):
+    """Return True if pw is the password of pw_hash."""
+    hasher = _hasher_for(pw_hash)
+    return bool(hasher and hasher.verify(login_name, pw, pw_hash))
+
+
+def needs_rehash(pw_hash):
+    """Return True if pw_hash was not created by DEFAULT_HASHER with its
+    current parameters."""
+    hasher = _hasher_for(pw_hash)
+    return hasher is not DEFAULT_HASHER or hasher.needs_rehash(pw_hash)
+
+
+def benchmark(hasher = None, seconds = 1.0):
+    """Return the hashes per second of a hasher on one core.
+
+    Python runs one thread at a time, so hashing in a loop uses one core.
+    Arguments:
+    hasher -- the hasher, default DEFAULT_HASHER
+    seconds -- minimum duration of the benchmark
+    """
+    hasher = hasher or DEFAULT_HASHER
+    count = 0
+    start = time.time()
+    while True:
+        hasher.make_hash('user@example.com', 'Benchmark1')
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def calibrate(target_ms, seconds = 1.0):
+    """Return the PBKDF2 iterations that take about target_ms per hash.
+
+    Measure the time of one iteration on this machine and scale.
+    Arguments:
+    target_ms -- time budget for hashing one password in milliseconds
+    seconds -- minimum duration of the measurement
+    """
+    probe = Pbkdf2Hasher(iterations = 1000)
+    hashes_per_second = benchmark(probe, seconds)
+    ms_per_iteration = 1000.0 / hashes_per_second / probe.iterations
+    # Round down to full thousands, but use at least 1000 iterations.
+    return max(1000, int(target_ms / ms_per_iteration) // 1000 * 1000)
@@ -0,0 +1,198 @@
+"""Token-bucket rate limiting in memcache
+
+Every route has a Limit per scope: 'ip' for the address of the client
+and 'email' for the email address the request is about. A Limit is a
+token bucket: it holds up to capacity tokens, refills capacity tokens
+per period and every request takes one token. A request without a token
+is rejected, see Handler.rate_limited(). The handlers check the limits
+first, before any password hashing, query or email.
+
+The state of a bucket is '<tokens>:<time>' in memcache, updated with
+compare-and-set, so concurrent requests on different instances can not
+take the same token. If memcache is down, requests are allowed.
+A request takes tokens only if all of its buckets have one: allow() reads
+all buckets first, and if a bucket runs empty while the tokens are taken,
+it gives the tokens it already took back. So a request that is rejected
+by one scope, e.g. 'ip', does not use up the bucket of another scope,
+e.g. the 'email' of the victim of an attacker.
+Rejected requests are counted per route and scope in memcache, see
+rejection_counts() and RateLimitStatsHandler.
+
+Classes:
+Limit -- Capacity and refill period of a token bucket.
+
+Functions:
+allow -- Take a token for every scope of a request.
+take_token -- Take a token from a bucket.
+give_token -- Give a token back to a bucket.
+rejection_counts -- Return the number of rejected requests.
+"""
+
+import time
+import hashlib
+import logging
+
+from google.appengine.api import memcache
+
+
+class Limit(object):
+    """Capacity and refill period of a token bucket"""
+
+    def __init__(self, capacity, period):
+        """Arguments:
+        capacity -- maximum number of tokens, the size of a burst
+        period -- seconds to refill capacity tokens
+        """
+        self.capacity = capacity
+        self.period = period
+        self.rate = float(capacity) / period
+
+
+# Limits of the routes: {route: {scope: Limit}}.
+# Change them here, scopes without a Limit are not limited.
+ROUTE_LIMITS = {
+    'login': {'ip': Limit(30, 300),
+              'email': Limit(10, 300)},
+    'forgot_password': {'ip': Limit(10, 3600),
+                        'email': Limit(3, 3600)},
+    'contact': {'ip': Limit(5, 3600),
+                'email': Limit(5, 3600)},
+    'send_email': {'ip': Limit(10, 3600),
+                   'email': Limit(5, 24 * 3600)},
+}
+
+# Memcache namespace of the buckets and the rejection counters.
+NAMESPACE = 'rate_limit'
+
+# Number of compare-and-set attempts before a request is rejected.
+CAS_ATTEMPTS = 3
+
+
+def _bucket_key(route, scope, value):
+    # Email addresses can be longer than a memcache key.
+    return 'bucket:%s:%s:%s' % (route, scope,
+                                hashlib.md5(value.encode('utf-8')).hexdigest())
+
+
+def _counter_key(route, scope):
+    return 'rejected:%s:%s' % (route, scope)
+
+
+def _tokens(state, limit, now):
+    # Tokens of a bucket state at the time now, a missing bucket is full.
+    if state is None:
+        return limit.capacity
+    tokens, last = [float(x) for x in state.split(':')]
+    return min(limit.capacity, tokens + (now - last) * limit.rate)
+
+
+def take_token(key, limit, now = None):
+    """Take a token from a bucket.
+
+    Arguments:
+    key -- memcache key of the bucket
+    limit -- the Limit of the bucket
+    now -- current time in seconds, default time.time()
+    Return value:
+    True if a token was taken, False if the bucket is empty.
+    """
+    now = now or time.time()
+    client = memcache.Client()
+    for attempt in range(CAS_ATTEMPTS):
+        state = client.gets(key, namespace = NAMESPACE)
+        if state is None:
+            # A full bucket, minus the token of this request.
+            if client.add(key, '%f:%f' % (limit.capacity - 1, now),
+                          time = limit.period, namespace = NAMESPACE):
+                return True
+            if client.get(key, namespace = NAMESPACE) is None:
+                # memcache is not available.
+                return True
+            continue
+        tokens = _tokens(state, limit, now)
+        if tokens < 1:
+            return False
+        if client.cas(key, '%f:%f' % (tokens - 1, now),
+                      time = limit.period, namespace = NAMESPACE):
+            return True
+    # Too many concurrent requests for the same bucket.
+    return False
+
+
+def give_token(key, limit, now = None):
+    """Give a token back to a bucket, e.g. of a rejected request.
+
+    Arguments:
+    key -- memcache key of the bucket
+    limit -- the Limit of the bucket
+    now -- current time in seconds, default time.time()
+    """
+    now = now or time.time()
+    client = memcache.Client()
+    for attempt in range(CAS_ATTEMPTS):
+        state = client.gets(key, namespace = NAMESPACE)
+        if state is None:
+            # The bucket expired, it is full.
+            return
+        tokens = min(limit.capacity, _tokens(state, limit, now) + 1)
+        if client.cas(key, '%f:%f' % (tokens, now),
+                      time = limit.period, namespace = NAMESPACE):
+            return
+
+
+def allow(route, **scopes):
+    """Take a token for every scope of a request.
+
+    Arguments:
+    route -- name of the route in ROUTE_LIMITS
+    scopes -- the value of every scope, e.g. ip = '10.0.0.1',
+    email = 'user@example.com', empty values are not limited
+    Return value:
+    True if the request is allowed, False if it must be rejected.
+    """
+    limits = ROUTE_LIMITS.get(route, {})
+    buckets = [(scope, _bucket_key(route, scope, scopes[scope].lower()),
+                limits[scope])
+               for scope in sorted(scopes)
+               if scopes[scope] and limits.get(scope)]
+    if not buckets:
+        return True
+    now = time.time()
+
+    # Check all buckets with one memcache read before taking any token.
+    states = memcache.get_multi([key for scope, key, limit in buckets],
+                                namespace = NAMESPACE)
+    for scope, key, limit in buckets:
+        if _tokens(states.get(key), limit, now) < 1:
+            _reject(route, scope)
+            return False
+
+    taken = []
+    for scope, key, limit in buckets:
+        if not take_token(key, limit, now):
+            # Emptied by a concurrent request since the check.
+            for taken_key, taken_limit in taken:
+                give_token(taken_key, taken_limit, now)
+            _reject(route, scope)
+            return False
+        taken.append((key, limit))
+    return True
+
+
+def _reject(route, scope):
+    logging.warning('Rate limit of %s per %s exceeded.' % (route, scope))
+    memcache.incr(_counter_key(route, scope), namespace = NAMESPACE,
+                  initial_value = 0)
+
+
+def rejection_counts():
+    """Return the number of rejected requests since the last memcache flush.
+
+    Return value:
+    dictionary {(route, scope): number of rejected requests}
+    """
+    keys = dict((_counter_key(route, scope), (route, scope))
+                for route, limits in ROUTE_LIMITS.iteritems()
+                for scope in limits)
+    counters = memcache.get_multi(keys.keys(), namespace = NAMESPACE)
+    return dict((keys[key], int(counters.get(key, 0))) for key in keys)
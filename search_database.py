@@ -0,0 +1,258 @@
+"""Datastore model and functions for the full-text search of articles
+
+The search uses an inverted index: for every term of an article there is
+one SearchPosting-entity with the term, the Article-id and a score.
+A search reads the best postings of every term of the query with one
+projection query per term, so its cost does not grow with the number of
+articles. A term with more than MAX_POSTINGS_PER_TERM postings is
+truncated to its best postings, search() then reports the results as
+truncated. The postings read for a term are cached under the term, a
+change of an article invalidates only the entries of its terms.
+The index is updated incrementally when an article is created, edited or
+removed. The handlers defer the update to a task (defer_index_article()),
+so saving an article does not wait for the writes of its postings.
+
+Classes:
+SearchPosting -- Model for the postings of the inverted index
+
+Functions:
+tokenize -- Return the list of terms of a text.
+term_scores -- Return the scores of the terms of an article.
+index_article -- Update the postings of an article.
+reindex_article -- Update the postings of a stored article by its id.
+defer_index_article -- Update the postings of an article in a task.
+unindex_articles -- Delete the postings of a list of articles.
+search -- Return the ranked Article-ids for a query.
+"""
+
+import re
+import math
+import logging
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.api import taskqueue
+
+from cache import CacheNamespace
+
+
+# Best postings of hot terms, see search(). The entries of the terms of
+# an article are deleted when its postings change.
+SEARCH_CACHE = CacheNamespace('search', 3)
+# Postings cached by a search that overlapped an index update may miss
+# the update, they expire after SEARCH_CACHE_TIME seconds.
+SEARCH_CACHE_TIME = 600
+
+# Terms with fewer or more characters are not indexed.
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 30
+# Only the terms with the best scores of an article are indexed, so
+# indexing an article needs a bounded number of writes.
+MAX_TERMS_PER_ARTICLE = 200
+# A term in the title counts as much as TITLE_WEIGHT terms in the body.
+TITLE_WEIGHT = 3
+# Only the first MAX_QUERY_TERMS terms of a query are searched.
+MAX_QUERY_TERMS = 5
+# Number of postings read per query term. Articles that only match the
+# truncated postings of a very common term are not found, see search().
+MAX_POSTINGS_PER_TERM = 500
+# Maximum number of postings of one batched delete.
+DELETE_BATCH_SIZE = 500
+
+STOPWORDS = frozenset('''a an and are as at be but by for from has have he
+    her his i if in into is it its not of on or our she so than that the
+    their them then there these they this to was we were what when which
+    who will with you your'''.split())
+
+# \w+ can not backtrack, tokenizing runs in linear time.
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchPosting(db.Model):
+    """Datastore model for the postings of the inverted index
+
+    The key name is '<term>:<Article-id>', so every term of an article
+    has exactly one posting.
+    """
+
+    term = db.StringProperty(required = True)
+    article = db.IntegerProperty(required = True)
+    score = db.FloatProperty(required = True)
+
+    @classmethod
+    def key_for(cls, term, article_id):
+        return db.Key.from_path('SearchPosting',
+                                u'%s:%d' % (term, int(article_id)))
+
+
+def tokenize(text):
+    """Return the list of terms of a text, lower case and without stopwords.
+
+    Argument:
+    text -- the text [string]
+    Return value:
+    list of terms in the order of the text, with duplicates
+    """
+    return [term for term in TERM_RE.findall(text.lower())
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH
+            and term not in STOPWORDS]
+
+
+def term_scores(title, body):
+    """Return the scores of the terms of an article.
+
+    The score grows with the logarithm of the number of occurrences,
+    terms in the title count TITLE_WEIGHT times.
+    Arguments:
+    title -- title of the article
+    body -- body of the article
+    Return value:
+    dictionary {term: score} with the MAX_TERMS_PER_ARTICLE best terms
+    """
+    counts = {}
+    for term in tokenize(title):
+        counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+    for term in tokenize(body):
+        counts[term] = counts.get(term, 0) + 1
+    best = sorted(counts.iteritems(), key = lambda item: -item[1])
+    return dict((term, 1.0 + math.log(count))
+                for term, count in best[:MAX_TERMS_PER_ARTICLE])
+
+
+def index_article(article):
+    """Update the postings of an article.
+
+    Write the postings of the current terms with one batched put and
+    delete the postings of terms the article no longer contains with
+    batched deletes of at most DELETE_BATCH_SIZE keys. The cached postings
+    of the old and the new terms are invalidated.
+    Argument:
+    article -- a stored Article-object
+    """
+    article_id = article.key().id()
+    scores = term_scores(article.title, article.body)
+    old_keys = SearchPosting.all(keys_only = True)\
+                            .filter('article', article_id).fetch(None)
+    new_keys = set(SearchPosting.key_for(term, article_id)
+                   for term in scores)
+    _delete([key for key in old_keys if key not in new_keys])
+    db.put([SearchPosting(key = SearchPosting.key_for(term, article_id),
+                          term = term,
+                          article = article_id,
+                          score = score)
+            for term, score in scores.iteritems()])
+    _invalidate_terms(set(_term_of(key) for key in old_keys) | set(scores))
+
+
+def reindex_article(article_id):
+    """Update the postings of a stored article by its id.
+
+    The task of defer_index_article(). It reads the current version of the
+    article, so the last task of several edits indexes the last edit.
+    The postings of an article removed in the meantime are deleted.
+    Argument:
+    article_id -- Article-id
+    """
+    article = db.get(db.Key.from_path('Article', int(article_id)))
+    if article is None:
+        unindex_articles([article_id])
+    else:
+        index_article(article)
+
+
+def defer_index_article(article_id):
+    """Update the postings of an article in a task, see reindex_article().
+
+    Argument:
+    article_id -- Article-id
+    """
+    try:
+        deferred.defer(reindex_article, int(article_id))
+    except taskqueue.Error:
+        # The article is saved, only the search index is outdated.
+        logging.warning('Could not defer the indexing of article %d.'
+                        % int(article_id))
+
+
+def unindex_articles(article_ids):
+    """Delete the postings of a list of articles.
+
+    Argument:
+    article_ids -- list of Article-ids
+    """
+    # Run the queries of all articles in parallel.
+    queries = [SearchPosting.all(keys_only = True)
+                            .filter('article', int(article_id)).run()
+               for article_id in article_ids]
+    keys = [key for query in queries for key in query]
+    _delete(keys)
+    _invalidate_terms(set(_term_of(key) for key in keys))
+
+
+def _delete(keys):
+    # Every article has up to MAX_TERMS_PER_ARTICLE postings.
+    for i in xrange(0, len(keys), DELETE_BATCH_SIZE):
+        db.delete(keys[i:i + DELETE_BATCH_SIZE])
+
+
+def _term_of(key):
+    # The key name of a posting is '<term>:<Article-id>'.
+    return key.name().rsplit(u':', 1)[0]
+
+
+def _cache_key(term):
+    return term.encode('utf-8')
+
+
+def _invalidate_terms(terms):
+    if terms:
+        SEARCH_CACHE.delete_multi([_cache_key(term) for term in terms])
+
+
+def search(query):
+    """Return the ranked Article-ids for a query.
+
+    Articles that contain more terms of the query rank first, then the
+    sum of the scores decides. The postings read for a term are cached.
+    Only the best MAX_POSTINGS_PER_TERM postings of a term are read. If a
+    term has more, the results are truncated: articles that match only 
+    the postings that were not read are missing.
+    Argument:
+    query -- the search query [string]
+    Return value:
+    (list of Article-ids, best first, True if the results are truncated)
+    """
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], False
+    cached = SEARCH_CACHE.get_multi([_cache_key(term) for term in terms])
+    missing = [term for term in terms if _cache_key(term) not in cached]
+
+    # Run the queries of the missing terms in parallel. They read only
+    # article and score from the index, one posting more than the
+    # maximum to detect truncation.
+    limit = MAX_POSTINGS_PER_TERM + 1
+    queries = [(term, SearchPosting.all(projection = ('article', 'score'))
+                                   .filter('term', term).order('-score')
+                                   .run(limit = limit, batch_size = limit))
+               for term in missing]
+    read = {}
+    for term, query in queries:
+        postings = [(posting.article, posting.score) for posting in query]
+        read[_cache_key(term)] = (postings[:MAX_POSTINGS_PER_TERM],
+                                  len(postings) > MAX_POSTINGS_PER_TERM)
+    if read:
+        SEARCH_CACHE.set_multi(read, SEARCH_CACHE_TIME)
+    cached.update(read)
+
+    matches = {}
+    scores = {}
+    truncated = False
+    for postings, term_truncated in cached.itervalues():
+        truncated = truncated or term_truncated
+        for article_id, score in postings:
+            matches[article_id] = matches.get(article_id, 0) + 1
+            scores[article_id] = scores.get(article_id, 0) + score
+    article_ids = sorted(scores,
+                         key = lambda a: (-matches[a], -scores[a], -a))
+    return article_ids, truncated
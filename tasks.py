@@ -0,0 +1,307 @@
+"""Background tasks and the handlers that start them
+
+The tasks run with the deferred library on the default task queue.
+The URLs below /tasks/ are restricted to admins in app.yaml.
+Task queues can call them, they run as admin.
+
+Functions:
+backfill_article_summaries -- Create the missing ArticleSummary-objects.
+backfill_search_index -- Add all articles to the search index.
+backfill_user_index -- Create the missing Username- and Email-objects.
+expire_entities -- Delete the entities of a kind older than its retention.
+rename_author -- Update the author name stored on the articles of a user.
+delete_author_articles -- Archive and delete the articles of a user.
+defer_delete_author_articles -- Defer the next batch of an account deletion.
+
+Classes:
+BackfillSummariesHandler -- Start backfill_article_summaries.
+BackfillSearchIndexHandler -- Start backfill_search_index.
+BackfillUserIndexHandler -- Start backfill_user_index.
+MailWorkerHandler -- Send a batch of emails from the task queue 'mail'.
+ResumeAccountDeletionsHandler -- Restart unfinished account deletions.
+ExpireEntitiesHandler -- Start expire_entities for every kind in RETENTION.
+"""
+
+import json
+import logging
+import datetime
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.api import taskqueue
+
+from handler import Handler
+import mail_queue
+import search_database
+from user_database import User, AccountDeletion, Username, Email,\
+                          ResetPasswordRequest, DeactAccounts,\
+                          UserIndexBackfill, USER_INDEX_CACHE,\
+                          RESET_REQUEST_LIFETIME
+from article_database import Article, ArticleSummary, DeletdArticle,\
+                             ARTICLE_CACHE, ARTICLE_SUMMARY_CACHE
+
+# Number of entities processed by one task.
+BATCH_SIZE = 100
+# Time the entities of a kind are kept after their creation, by kind.
+# They are deleted by expire_entities(), started daily by cron.
+# None keeps the entities forever.
+RETENTION = {
+    'ResetPasswordRequest': RESET_REQUEST_LIFETIME,
+    'DeactAccounts': datetime.timedelta(days = 365),
+    'DeletdArticle': datetime.timedelta(days = 365),
+}
+# The models of the kinds in RETENTION, they need a 'created' property.
+RETENTION_MODELS = {
+    'ResetPasswordRequest': ResetPasswordRequest,
+    'DeactAccounts': DeactAccounts,
+    'DeletdArticle': DeletdArticle,
+}
+
+# Indexing an article writes up to MAX_TERMS_PER_ARTICLE postings.
+SEARCH_BATCH_SIZE = 10
+
+
+def backfill_article_summaries(cursor = None):
+    """Create the ArticleSummary-objects for all articles.
+
+    Also store the author name on articles that do not have one yet.
+    Process one batch of articles and defer the next batch.
+    Argument:
+    cursor -- Datastore cursor of the batch, None for the first batch
+    """
+    query = Article.all()
+    if cursor:
+        query.with_cursor(cursor)
+    article_list = query.fetch(BATCH_SIZE)
+    if article_list:
+        authors = User.by_ids([article.author for article in article_list])
+        for article in article_list:
+            if not article.author_name and article.author in authors:
+                article.author_name = authors[article.author].name
+        db.put(article_list + [ArticleSummary.from_article(article) 
+                               for article in article_list])
+        deferred.defer(backfill_article_summaries, query.cursor())
+    else:
+        ARTICLE_CACHE.flush()
+        ARTICLE_SUMMARY_CACHE.flush()
+        Article.flush_homepage_cache()
+        logging.info('Article summaries backfilled.')
+
+
+def backfill_search_index(cursor = None):
+    """Add all articles to the search index.
+
+    Process one batch of articles and defer the next batch.
+    Argument:
+    cursor -- Datastore cursor of the batch, None for the first batch
+    """
+    query = Article.all()
+    if cursor:
+        query.with_cursor(cursor)
+    article_list = query.fetch(SEARCH_BATCH_SIZE)
+    if article_list:
+        for article in article_list:
+            search_database.index_article(article)
+        deferred.defer(backfill_search_index, query.cursor())
+    else:
+        logging.info('Search index backfilled.')
+
+
+def backfill_user_index(cursor = None):
+    """Create the Username- and Email-objects of all users.
+
+    Process one batch of users and defer the next batch. If a username
+    or email is used by more than one user, the first user keeps it and
+    a warning is logged. The last batch stores the UserIndexBackfill 
+    marker, which ends the fallback queries of User.by_index().
+    Argument:
+    cursor -- Datastore cursor of the batch, None for the first batch
+    """
+    query = User.all()
+    if cursor:
+        query.with_cursor(cursor)
+    user_list = query.fetch(BATCH_SIZE)
+    if user_list:
+        entries = []
+        for index in (Username, Email):
+            keys = [index.key_for(index.value_of(user)) for user in user_list]
+            existing = db.get(keys)
+            for key, entry, user in zip(keys, existing, user_list):
+                if entry is None:
+                    entries.append(index(key = key, uid = user.key().id()))
+                elif entry.uid != user.key().id():
+                    logging.warning('%s %s of user %d is used by user %d.'
+                                    % (index.kind(), key.name(), 
+                                       user.key().id(), entry.uid))
+        # Two users of the batch can have the same value, keep the first.
+        unique = {}
+        for entry in entries:
+            unique.setdefault(entry.key(), entry)
+        db.put(unique.values())
+        deferred.defer(backfill_user_index, query.cursor())
+    else:
+        USER_INDEX_CACHE.flush()
+        UserIndexBackfill.mark_done()
+        logging.info('User index backfilled.')
+
+
+def rename_author(uid, cursor = None):
+    """Store the current username of a user on all of the user's articles.
+
+    Process one batch of articles, write the articles and their summaries
+    with one batched put, flush the homepage cache if the batch changed
+    articles and defer the next batch.
+    The name is read from the User-object for every batch, so the last 
+    rename wins if a user is renamed again while the task is running.
+    Arguments:
+    uid -- User-id of the author
+    cursor -- Datastore cursor of the batch, None for the first batch
+    """
+    user = User.get_by_id(int(uid))
+    if not user:
+        return
+    query = Article.keys_by_author(uid)
+    if cursor:
+        query.with_cursor(cursor)
+    key_list = query.fetch(BATCH_SIZE)
+    if key_list:
+        article_list = [article for article in db.get(key_list) 
+                        if article and article.author_name != user.name]
+        for article in article_list:
+            article.author_name = user.name
+        if article_list:
+            db.put(article_list + [ArticleSummary.from_article(article)
+                                   for article in article_list])
+            article_ids = [article.key().id() for article in article_list]
+            ARTICLE_CACHE.delete_multi(article_ids)
+            ARTICLE_SUMMARY_CACHE.delete_multi(article_ids)
+            # Show the new name of this batch on the homepage and the
+            # author pages now, not only after the last batch.
+            Article.flush_homepage_cache()
+        deferred.defer(rename_author, uid, query.cursor())
+
+
+def delete_author_articles(uid):
+    """Archive and delete all articles of a deleted user.
+
+    Process one batch of articles and defer the next batch: store them 
+    in the DeletdArticle DB with one batched put, then delete articles
+    and summaries with one batched delete.
+    The progress is stored in the AccountDeletion-object of the user, 
+    so the task continues where it stopped if it is started again.
+    The tasks are named by the progress, see defer_delete_author_articles().
+    Argument:
+    uid -- User-id of the deleted user
+    """
+    job = AccountDeletion.by_uid(uid) or AccountDeletion.start(uid)
+    if job.done:
+        return
+    query = Article.all().filter('author', int(uid))
+    if job.cursor:
+        query.with_cursor(job.cursor)
+    article_list = query.fetch(BATCH_SIZE)
+    if article_list:
+        db.put([DeletdArticle.from_article(article) 
+                for article in article_list])
+        Article.remove_multi([article.key().id() for article in article_list])
+        job.articles_deleted += len(article_list)
+        job.cursor = query.cursor()
+        job.put()
+        defer_delete_author_articles(job)
+    else:
+        job.done = True
+        job.put()
+        logging.info('Deleted %d articles of user %s.' 
+                     % (job.articles_deleted, uid))
+
+
+def expire_entities(kind, cutoff = None, cursor = None):
+    """Delete the entities of a kind that are older than its retention.
+
+    Process one batch with a keys-only query on 'created', delete it with
+    one batched delete and defer the next batch.
+    Arguments:
+    kind -- the name of the kind in RETENTION
+    cutoff -- entities created before this time are deleted, set by the
+    first batch, so all batches delete the same entities
+    cursor -- Datastore cursor of the batch, None for the first batch
+    """
+    retention = RETENTION.get(kind)
+    if retention is None:
+        return
+    if cutoff is None:
+        cutoff = datetime.datetime.now() - retention
+    query = RETENTION_MODELS[kind].all(keys_only = True)\
+                                  .filter('created <', cutoff)
+    if cursor:
+        query.with_cursor(cursor)
+    key_list = query.fetch(BATCH_SIZE)
+    if key_list:
+        db.delete(key_list)
+        deferred.defer(expire_entities, kind, cutoff, query.cursor())
+    else:
+        logging.info('Expired %s entities created before %s.' 
+                     % (kind, cutoff))
+
+
+def defer_delete_author_articles(job):
+    """Defer the next batch of an account deletion.
+
+    The task name contains the User-id and the number of deleted articles,
+    so there is only one task per batch, even if the cron job resumes a
+    deletion that is still running. If the task can not be added, the
+    deletion is resumed by the cron job, see ResumeAccountDeletionsHandler.
+    Argument:
+    job -- the AccountDeletion-object of the user
+    """
+    try:
+        deferred.defer(delete_author_articles, job.uid,
+                       _name = 'delete-articles-%d-%d' 
+                               % (job.uid, job.articles_deleted))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        # The task of this batch is already queued or running.
+        pass
+    except taskqueue.Error:
+        logging.warning('Could not defer the deletion of the articles of '
+                        'user %d.' % job.uid)
+
+
+class BackfillSummariesHandler(Handler):
+    def get(self):
+        deferred.defer(backfill_article_summaries)
+        self.write('Backfill of article summaries started.')
+
+
+class BackfillSearchIndexHandler(Handler):
+    def get(self):
+        deferred.defer(backfill_search_index)
+        self.write('Backfill of the search index started.')
+
+
+class BackfillUserIndexHandler(Handler):
+    def get(self):
+        deferred.defer(backfill_user_index)
+        self.write('Backfill of the user index started.')
+
+
+class MailWorkerHandler(Handler):
+    def post(self):
+        payload = json.loads(self.request.body)
+        mail_queue.send_batch(payload['messages'], payload['attempt'],
+                              task_name = self.request.headers.get(
+                                  'X-AppEngine-TaskName'))
+
+
+class ResumeAccountDeletionsHandler(Handler):
+    def get(self):
+        # Called by cron (see cron.yaml).
+        for job in AccountDeletion.all().filter('done', False):
+            defer_delete_author_articles(job)
+
+
+class ExpireEntitiesHandler(Handler):
+    def get(self):
+        # Called by cron (see cron.yaml).
+        for kind in RETENTION:
+            deferred.defer(expire_entities, kind)
@@ -0,0 +1,66 @@
+"""Unit tests with the local service stubs of the App Engine SDK (testbed)
+
+Run from the root of the repository with the path of the SDK in GAE_SDK:
+
+    GAE_SDK=/path/to/google_appengine python -m unittest discover -t . -s tests
+
+Classes:
+TestbedCase -- Base class of the tests that use the App Engine services.
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.environ['GAE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+import cache
+
+
+class TestbedCase(unittest.TestCase):
+    """Base class of the tests that use the App Engine services
+
+    Every test gets an empty datastore, memcache and task queue. The
+    datastore is strongly consistent and checks the queries against
+    index.yaml, like production does.
+    """
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability = 1)
+        self.testbed.init_datastore_v3_stub(consistency_policy = policy,
+                                            require_indexes = True,
+                                            root_path = ROOT)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path = ROOT)
+        self.testbed.init_app_identity_stub()
+        reset_local_caches()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+
+def reset_local_caches():
+    """Forget the LocalCaches and memcache counters of the last test.
+
+    The ids of the new datastore start again at 1, so a cached object of
+    the last test would be found under the id of a new one.
+    """
+    for namespace in cache._local_namespaces:
+        namespace.local.clear()
+        namespace._state = None
+        namespace._changed.clear()
+        namespace._cleared = 0
@@ -0,0 +1,78 @@
+"""Tests of the ETag / Last-Modified handling of Handler.not_modified()"""
+
+import datetime
+
+import webapp2
+
+from tests import TestbedCase
+from handler import Handler, SessionClaims, GZIP_ETAG_SUFFIX
+
+
+LAST_MODIFIED = datetime.datetime(2024, 5, 1, 12, 0, 0)
+
+
+class NotModifiedTest(TestbedCase):
+
+    def handler(self, **headers):
+        request = webapp2.Request.blank('/', headers = headers)
+        return Handler(request, webapp2.Response())
+
+    def etag(self, version = 'v1'):
+        # The ETag of an anonymous response, without quotes.
+        h = self.handler()
+        h.not_modified(version, LAST_MODIFIED)
+        return h.response.headers['ETag'].strip('"')
+
+    def test_unconditional_request_sets_headers(self):
+        h = self.handler()
+        self.assertFalse(h.not_modified('v1', LAST_MODIFIED, max_age = 60))
+        self.assertEqual(h.response.status_int, 200)
+        self.assertTrue(h.response.headers['ETag'])
+        self.assertEqual(h.response.headers['Cache-Control'],
+                         'public, max-age=60')
+        self.assertIn('Cookie', h.response.headers['Vary'])
+        self.assertIn('Accept-Encoding', h.response.headers['Vary'])
+        self.assertEqual(h.response.last_modified.replace(tzinfo = None),
+                         LAST_MODIFIED)
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.etag()
+        h = self.handler(**{'If-None-Match': '"%s"' % etag})
+        self.assertTrue(h.not_modified('v1', LAST_MODIFIED))
+        self.assertEqual(h.response.status_int, 304)
+        self.assertEqual(h.response.headers['ETag'], '"%s"' % etag)
+
+    def test_gzip_etag_matches_and_is_returned(self):
+        tag = self.etag() + GZIP_ETAG_SUFFIX
+        h = self.handler(**{'If-None-Match': '"%s"' % tag})
+        self.assertTrue(h.not_modified('v1', LAST_MODIFIED))
+        self.assertEqual(h.response.headers['ETag'], '"%s"' % tag)
+
+    def test_new_version_is_modified(self):
+        etag = self.etag('v1')
+        h = self.handler(**{'If-None-Match': '"%s"' % etag})
+        self.assertFalse(h.not_modified('v2', LAST_MODIFIED))
+        self.assertEqual(h.response.status_int, 200)
+
+    def test_if_modified_since(self):
+        h = self.handler(**{'If-Modified-Since':
+                            'Wed, 01 May 2024 12:00:00 GMT'})
+        self.assertTrue(h.not_modified('v1', LAST_MODIFIED))
+        h = self.handler(**{'If-Modified-Since':
+                            'Wed, 01 May 2024 11:59:59 GMT'})
+        self.assertFalse(h.not_modified('v1', LAST_MODIFIED))
+
+    def test_if_none_match_wins_over_if_modified_since(self):
+        h = self.handler(**{'If-None-Match': '"other"',
+                            'If-Modified-Since':
+                            'Wed, 01 May 2024 12:00:00 GMT'})
+        self.assertFalse(h.not_modified('v1', LAST_MODIFIED))
+
+    def test_session_changes_etag_and_cache_control(self):
+        anonymous = self.etag()
+        h = self.handler(**{'If-None-Match': '"%s"' % anonymous})
+        h.claims = SessionClaims(1, 'alice', 0, 0)
+        self.assertFalse(h.not_modified('v1', LAST_MODIFIED, max_age = 60))
+        self.assertNotEqual(h.response.headers['ETag'], '"%s"' % anonymous)
+        self.assertEqual(h.response.headers['Cache-Control'],
+                         'private, max-age=60')
@@ -0,0 +1,96 @@
+"""Tests of the token buckets of rate_limit.allow()"""
+
+from google.appengine.api import memcache
+
+from tests import TestbedCase
+import rate_limit
+from rate_limit import Limit, allow, take_token, rejection_counts
+
+
+class RateLimitTest(TestbedCase):
+
+    def setUp(self):
+        TestbedCase.setUp(self)
+        self.addCleanup(setattr, rate_limit, 'ROUTE_LIMITS',
+                        rate_limit.ROUTE_LIMITS)
+        rate_limit.ROUTE_LIMITS = {'test': {'ip': Limit(3, 3600),
+                                            'email': Limit(2, 3600)}}
+
+    def tokens(self, scope, value):
+        key = rate_limit._bucket_key('test', scope, value)
+        state = memcache.get(key, namespace = rate_limit.NAMESPACE)
+        return rate_limit._tokens(state,
+                                  rate_limit.ROUTE_LIMITS['test'][scope],
+                                  float(state.split(':')[1]))
+
+    def test_burst_of_capacity_then_rejected(self):
+        for i in range(3):
+            self.assertTrue(allow('test', ip = '10.0.0.1'))
+        self.assertFalse(allow('test', ip = '10.0.0.1'))
+        # Other clients have their own bucket.
+        self.assertTrue(allow('test', ip = '10.0.0.2'))
+        self.assertEqual(rejection_counts()[('test', 'ip')], 1)
+
+    def test_refill(self):
+        limit = Limit(1, 10)
+        self.assertTrue(take_token('bucket', limit, now = 1000.0))
+        self.assertFalse(take_token('bucket', limit, now = 1005.0))
+        self.assertTrue(take_token('bucket', limit, now = 1010.0))
+
+    def test_unknown_route_and_empty_scope_are_allowed(self):
+        self.assertTrue(allow('other', ip = '10.0.0.1'))
+        for i in range(3):
+            self.assertTrue(allow('test', ip = '10.0.0.1', email = ''))
+        self.assertAlmostEqual(self.tokens('ip', '10.0.0.1'), 0, places = 2)
+
+    def test_emails_are_case_insensitive(self):
+        self.assertTrue(allow('test', email = 'Alice@example.com'))
+        self.assertTrue(allow('test', email = 'alice@EXAMPLE.com'))
+        self.assertFalse(allow('test', email = 'alice@example.com'))
+
+    def test_rejected_scope_does_not_use_other_buckets(self):
+        # An attacker empties the bucket of their address ...
+        for i in range(3):
+            allow('test', ip = '10.0.0.1', email = 'a%d@example.com' % i)
+        # ... further requests do not take the tokens of the victim.
+        for i in range(5):
+            self.assertFalse(allow('test', ip = '10.0.0.1',
+                                   email = 'victim@example.com'))
+        self.assertTrue(allow('test', ip = '10.0.0.2',
+                              email = 'victim@example.com'))
+        self.assertTrue(allow('test', ip = '10.0.0.3',
+                              email = 'victim@example.com'))
+        self.assertEqual(rejection_counts()[('test', 'ip')], 5)
+        self.assertEqual(rejection_counts()[('test', 'email')], 0)
+
+    def test_tokens_given_back_on_race(self):
+        # The ip bucket is emptied by a concurrent request after the
+        # check of allow() read it as full.
+        for i in range(3):
+            allow('test', ip = '10.0.0.1')
+        self.addCleanup(setattr, rate_limit.memcache, 'get_multi',
+                        rate_limit.memcache.get_multi)
+        rate_limit.memcache.get_multi = lambda keys, namespace: {}
+        self.assertFalse(allow('test', ip = '10.0.0.1',
+                               email = 'victim@example.com'))
+        # The email bucket was taken first (sorted scopes) and refilled.
+        self.assertAlmostEqual(self.tokens('email', 'victim@example.com'),
+                               2, places = 2)
+
+    def test_cas_conflict(self):
+        # Another request changes the bucket between gets() and cas().
+        limit = Limit(5, 3600)
+        self.assertTrue(take_token('bucket', limit))
+        client_class = memcache.Client
+
+        class ConflictingClient(client_class):
+            def gets(self, key, namespace = None):
+                state = client_class.gets(self, key, namespace = namespace)
+                client_class().set(key, '1.000000:%s' % state.split(':')[1],
+                                   namespace = namespace)
+                return state
+
+        self.addCleanup(setattr, memcache, 'Client', client_class)
+        memcache.Client = ConflictingClient
+        # Every cas() fails, the request is rejected after CAS_ATTEMPTS.
+        self.assertFalse(take_token('bucket', limit))
@@ -0,0 +1,73 @@
+"""Tests of the ranking, truncation and invalidation of the article search"""
+
+from tests import TestbedCase
+from article_database import Article
+import search_database
+from search_database import index_article, unindex_articles, search
+
+
+class SearchTest(TestbedCase):
+
+    def article(self, title, body):
+        article = Article(title = title, body = body, author = 1)
+        article.put()
+        index_article(article)
+        return article.key().id()
+
+    def test_empty_query(self):
+        self.assertEqual(search(u''), ([], False))
+        # Only stopwords
+        self.assertEqual(search(u'the and of'), ([], False))
+
+    def test_more_matching_terms_rank_first(self):
+        one_term = self.article(u'Notes', u'python python python python')
+        two_terms = self.article(u'Notes', u'python appengine')
+        self.assertEqual(search(u'python appengine'),
+                         ([two_terms, one_term], False))
+
+    def test_score_ranks_equal_matches(self):
+        once = self.article(u'Notes', u'python')
+        often = self.article(u'Notes', u'python python python')
+        in_title = self.article(u'Python', u'python')
+        self.assertEqual(search(u'python'),
+                         ([in_title, often, once], False))
+
+    def test_terms_are_case_insensitive(self):
+        article_id = self.article(u'Datastore', u'notes')
+        self.assertEqual(search(u'DATASTORE'), ([article_id], False))
+
+    def test_truncated_term(self):
+        self.addCleanup(setattr, search_database, 'MAX_POSTINGS_PER_TERM',
+                        search_database.MAX_POSTINGS_PER_TERM)
+        search_database.MAX_POSTINGS_PER_TERM = 2
+        best = self.article(u'Python', u'python')
+        second = self.article(u'Python', u'notes')
+        self.article(u'Notes', u'python')
+        self.assertEqual(search(u'python'), ([best, second], True))
+
+    def test_reindex_invalidates_cached_term(self):
+        article_id = self.article(u'Notes', u'python memcache')
+        self.assertEqual(search(u'python'), ([article_id], False))
+        self.assertEqual(search(u'memcache'), ([article_id], False))
+        article = Article.get_by_id(article_id)
+        article.body = u'memcache only'
+        article.put()
+        index_article(article)
+        self.assertEqual(search(u'python'), ([], False))
+        self.assertEqual(search(u'memcache'), ([article_id], False))
+
+    def test_unindex_invalidates_cached_terms(self):
+        removed = self.article(u'Notes', u'python')
+        kept = self.article(u'Notes', u'python python')
+        self.assertEqual(search(u'python'), ([kept, removed], False))
+        unindex_articles([removed])
+        self.assertEqual(search(u'python'), ([kept], False))
+
+    def test_cached_term_needs_no_query(self):
+        article_id = self.article(u'Notes', u'python')
+        search(u'python')
+        # A cached term is not read from the datastore again.
+        self.addCleanup(delattr, search_database.SearchPosting, 'all')
+        search_database.SearchPosting.all = classmethod(
+            lambda cls, **kw: self.fail('The postings were queried.'))
+        self.assertEqual(search(u'python'), ([article_id], False))
@@ -0,0 +1,87 @@
+"""Tests of the uniqueness of usernames and emails in User.save()"""
+
+from tests import TestbedCase
+from user_database import User, Username, Email, UserIndexBackfill
+
+
+class UserSaveTest(TestbedCase):
+
+    def setUp(self):
+        TestbedCase.setUp(self)
+        UserIndexBackfill.mark_done()
+
+    def new_user(self, name, email):
+        # Without make_pw_hash(), the password is not used.
+        user = User(name = name, pw_hash = 'x', email = email)
+        return User.save(user), user
+
+    def index_uid(self, index, value):
+        entry = index.get(index.key_for(value))
+        return entry and entry.uid
+
+    def test_new_user_stores_index(self):
+        taken, user = self.new_user('Alice', 'alice@example.com')
+        self.assertIsNone(taken)
+        self.assertEqual(self.index_uid(Username, 'alice'), user.key().id())
+        self.assertEqual(self.index_uid(Email, 'ALICE@example.com'),
+                         user.key().id())
+        self.assertEqual(User.by_name('ALICE').key(), user.key())
+        self.assertEqual(User.by_email('alice@example.com').key(),
+                         user.key())
+
+    def test_taken_name_or_email(self):
+        self.new_user('Alice', 'alice@example.com')
+        self.assertEqual(self.new_user('alice', 'bob@example.com')[0],
+                         'name')
+        self.assertEqual(self.new_user('Bob', 'Alice@Example.com')[0],
+                         'email')
+        # The rejected users were not stored.
+        self.assertEqual(User.all().count(), 1)
+        self.assertIsNone(Email.get(Email.key_for('bob@example.com')))
+
+    def test_rename_frees_old_name(self):
+        taken, user = self.new_user('Alice', 'alice@example.com')
+        user.name = 'Carol'
+        self.assertIsNone(User.save(user, old_name = 'Alice'))
+        self.assertIsNone(Username.get(Username.key_for('alice')))
+        self.assertEqual(self.index_uid(Username, 'carol'), user.key().id())
+        self.assertIsNone(User.by_name('Alice'))
+        self.assertIsNone(self.new_user('alice', 'other@example.com')[0])
+
+    def test_rename_to_taken_name(self):
+        self.new_user('Alice', 'alice@example.com')
+        taken, bob = self.new_user('Bob', 'bob@example.com')
+        bob.name = 'ALICE'
+        self.assertEqual(User.save(bob, old_name = 'Bob'), 'name')
+        # The transaction was rolled back.
+        self.assertEqual(self.index_uid(Username, 'bob'), bob.key().id())
+        self.assertEqual(User.get_by_id(bob.key().id()).name, 'Bob')
+
+    def test_change_case_of_own_name(self):
+        taken, user = self.new_user('Bob', 'bob@example.com')
+        user.name = 'bob'
+        self.assertIsNone(User.save(user, old_name = 'Bob'))
+        self.assertEqual(self.index_uid(Username, 'bob'), user.key().id())
+        self.assertEqual(User.by_name('BOB').name, 'bob')
+
+    def test_change_email(self):
+        taken, user = self.new_user('Alice', 'alice@example.com')
+        user.email = 'new@example.com'
+        self.assertIsNone(User.save(user, old_email = 'alice@example.com'))
+        self.assertIsNone(Email.get(Email.key_for('alice@example.com')))
+        self.assertEqual(User.by_email('new@example.com').key(), user.key())
+        self.assertIsNone(User.by_email('alice@example.com'))
+
+    def test_other_users_entries_are_kept(self):
+        # A name used by two users before the index was case-insensitive
+        # stays with the user that owns the index entity.
+        taken, alice = self.new_user('Alice', 'alice@example.com')
+        legacy = User(name = 'ALICE', pw_hash = 'x',
+                      email = 'legacy@example.com')
+        legacy.put()
+        legacy.name = 'Legacy'
+        self.assertIsNone(User.save(legacy, old_name = 'ALICE'))
+        self.assertEqual(self.index_uid(Username, 'alice'), alice.key().id())
+        User.remove(legacy.key().id())
+        self.assertEqual(self.index_uid(Username, 'alice'), alice.key().id())
+        self.assertIsNone(self.index_uid(Username, 'legacy'))
@@ -0,0 +1,75 @@
+"""Startup benchmark: import time and first-request latency per route
+
+Usage: python tools/bench_startup.py [path to the App Engine SDK]
+
+For every route a new Python process imports main (like a new instance)
+and sends one GET request to the route. The App Engine services are the
+local stubs of the SDK (testbed), so the numbers show the cost of loading
+code and templates, not of RPCs. Compare the output before and after a 
+change to catch cold-start regressions.
+The SDK path can also be set in the environment variable GAE_SDK.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+ROUTES = ['/', '/article/?article=1', '/about', '/terms', '/privacy',
+          '/contact', '/login', '/signup', '/user_settings']
+
+FIRST_REQUEST = '''
+import os, sys, json, time
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(root)r)
+os.chdir(%(root)r)
+from google.appengine.ext import testbed
+bed = testbed.Testbed()
+bed.activate()
+bed.init_datastore_v3_stub()
+bed.init_memcache_stub()
+bed.init_taskqueue_stub(root_path = %(root)r)
+bed.init_mail_stub()
+
+start = time.time()
+import main
+imported = time.time()
+response = main.app.get_response(%(route)r)
+done = time.time()
+print json.dumps({'status': response.status_int,
+                  'import_ms': (imported - start) * 1000,
+                  'request_ms': (done - imported) * 1000,
+                  'modules': len(sys.modules)})
+'''
+
+
+def measure(sdk, route, runs = 3):
+    """Return the result of the fastest of runs cold starts for a route."""
+    code = FIRST_REQUEST % {'sdk': sdk, 'root': ROOT, 'route': route}
+    results = []
+    for i in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key = lambda r: r['import_ms'] + r['request_ms'])
+
+
+def main():
+    sdk = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('GAE_SDK')
+    if not sdk:
+        sys.exit(__doc__)
+    print '%-24s %6s %10s %11s %8s' % ('route', 'status', 'import ms',
+                                       'request ms', 'modules')
+    for route in ROUTES:
+        r = measure(sdk, route)
+        print '%-24s %6d %10.1f %11.1f %8d' % (route, r['status'], 
+                                               r['import_ms'], 
+                                               r['request_ms'], r['modules'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Cold-start benchmark of the template loading
+
+Usage: python tools/bench_templates.py
+
+Load every template once in a new Python process, as a new instance does
+on its first requests, with the FileSystemLoader (parse and compile) and 
+with the ModuleLoader (precompiled by tools/compile_templates.py).
+"""
+
+import os
+import sys
+import subprocess
+import tempfile
+import shutil
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import compile_templates
+
+COLD_START = '''
+import time
+start = time.time()
+import jinja2
+if %(compiled)r:
+    loader = jinja2.ModuleLoader(%(compiled)r)
+else:
+    loader = jinja2.FileSystemLoader(%(templates)r)
+env = jinja2.Environment(loader = loader, autoescape = True, 
+                         auto_reload = False)
+for name in %(names)r:
+    env.get_template(name)
+print (time.time() - start) * 1000
+'''
+
+
+def cold_start(names, compiled = None, runs = 5):
+    """Return the best time in ms to load all templates in a new process."""
+    code = COLD_START % {'compiled': compiled,
+                         'templates': compile_templates.TEMPLATE_DIR,
+                         'names': names}
+    times = []
+    for i in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(output))
+    return min(times)
+
+
+def main():
+    names = sorted(name for name in os.listdir(compile_templates.TEMPLATE_DIR)
+                   if name.endswith('.html'))
+    target = tempfile.mkdtemp()
+    try:
+        compile_templates.compile_templates(target)
+        source_ms = cold_start(names)
+        compiled_ms = cold_start(names, target)
+    finally:
+        shutil.rmtree(target)
+    print 'Templates: %d' % len(names)
+    print 'FileSystemLoader (parse and compile): %8.1f ms' % source_ms
+    print 'ModuleLoader (precompiled):           %8.1f ms' % compiled_ms
+
+
+if __name__ == '__main__':
+    main()
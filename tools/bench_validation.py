@@ -0,0 +1,60 @@
+"""Micro-benchmark of the input validation with worst-case inputs
+
+Usage: python tools/bench_validation.py
+
+Compare the regular expressions that were used before the validation
+module with the Field schemas, for inputs of the maximum allowed size
+and inputs that are just too large.
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import validation
+
+# The regular expressions used before the validation module.
+OLD = {
+    'BODY': re.compile(r"^(.|\n){1,20000}$"),
+    'CONTENT': re.compile(r"^(.|\n){1,1000}$"),
+    'EMAIL': re.compile(r"^[\S]+@[\S]+\.[\S]+$"),
+    'TITLE': re.compile(r"^.{1,78}$"),
+}
+
+CASES = [
+    ('BODY', 'max size, newlines', ('a' * 99 + '\n') * 200),
+    ('BODY', 'too large', 'a' * 20001 + '\n' + 'a' * 50000),
+    ('CONTENT', 'max size, newlines', ('a' * 9 + '\n') * 100),
+    ('CONTENT', 'too large', 'a' * 100000),
+    # Worst cases of the old regex within the 254 characters of EMAIL.
+    ('EMAIL', 'many @, no dot', 'a@' * 127),
+    ('EMAIL', '@. pairs, space', '@.' * 126 + ' '),
+    ('TITLE', 'max size', 'a' * 78),
+]
+
+
+def main():
+    number = 20
+    print '%-8s %-20s %12s %12s' % ('field', 'input', 'regex [ms]',
+                                      'Field [ms]')
+    for name, description, value in CASES:
+        old = OLD[name]
+        new = getattr(validation, name)
+        assert bool(old.match(value)) == new.valid(value) or \
+               len(value) > new.max_length
+        try:
+            old_time = timeit.timeit(lambda: old.match(value), 
+                                     number = number) / number * 1000
+            old_text = '%12.3f' % old_time
+        except RuntimeError:
+            old_text = '%12s' % 'error'
+        new_time = timeit.timeit(lambda: new.valid(value), 
+                                 number = number) / number * 1000
+        print '%-8s %-20s %s %12.3f' % (name, description, old_text, new_time)
+
+
+if __name__ == '__main__':
+    main()
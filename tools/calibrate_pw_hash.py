@@ -0,0 +1,31 @@
+"""Benchmark and calibrate the password hashing on this machine
+
+Usage: python tools/calibrate_pw_hash.py [target_ms]
+
+Print the hashes per second per core of the current hasher and the PBKDF2
+iterations that take target_ms (default 100) milliseconds per hash.
+Production instances are slower than most development machines, use 
+/admin/pw_hash_benchmark to get the numbers of the instances.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import password_hashing
+
+
+def main():
+    target_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    hasher = password_hashing.DEFAULT_HASHER
+    hashes_per_second = password_hashing.benchmark(hasher, seconds = 3)
+    print 'Hasher: %s, %d iterations' % (hasher.name, hasher.iterations)
+    print 'Hashes per second per core: %.1f' % hashes_per_second
+    print 'Milliseconds per hash: %.1f' % (1000.0 / hashes_per_second)
+    print 'Iterations for %.0f ms per hash: %d' % (
+        target_ms, password_hashing.calibrate(target_ms, seconds = 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Precompile all Jinja2 templates for production
+
+Usage: python tools/compile_templates.py [app version]
+
+Compile every template in templates/, including the email templates, into
+the directory compiled_templates/. Handler loads the templates from there 
+with the Jinja2 ModuleLoader, so new instances do not parse and compile 
+templates. Run this before every deploy, with the Jinja2 version of the
+libraries in app.yaml. The manifest.json in compiled_templates/ records
+the Jinja2 version and the version of the app it is deployed with, the 
+version in app.yaml unless it is given. If either does not match at 
+startup, Handler loads the templates from templates/ instead.
+Delete compiled_templates/ to load the templates from templates/ again.
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+
+import jinja2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from utils import TEMPLATE_MANIFEST
+
+TEMPLATE_DIR = os.path.join(ROOT, 'templates')
+TARGET_DIR = os.path.join(ROOT, 'compiled_templates')
+APP_YAML = os.path.join(ROOT, 'app.yaml')
+
+
+def app_version():
+    """Return the version in app.yaml."""
+    with open(APP_YAML) as f:
+        match = re.search(r'^version:\s*(\S+)', f.read(), re.MULTILINE)
+    return match.group(1).strip('"\'') if match else ''
+
+
+def compile_templates(version, target = TARGET_DIR):
+    """Compile all templates into the directory target.
+
+    Argument:
+    version -- the app version the templates are deployed with
+    Return value:
+    the number of compiled templates
+    """
+    # Must match the options of jinja_environment in handler.py
+    env = jinja2.Environment(loader = jinja2.FileSystemLoader(TEMPLATE_DIR),
+                             autoescape = True)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    names = env.list_templates()
+    env.compile_templates(target, zip = None, py_compile = False,
+                          ignore_errors = False)
+    with open(os.path.join(target, TEMPLATE_MANIFEST), 'w') as f:
+        json.dump({'jinja2_version': jinja2.__version__,
+                   'app_version': version}, f)
+    return len(names)
+
+
+def main():
+    version = sys.argv[1] if len(sys.argv) > 1 else app_version()
+    count = compile_templates(version)
+    print 'Compiled %d templates into %s with Jinja2 %s for version %s' % (
+        count, os.path.normpath(TARGET_DIR), jinja2.__version__, version)
+
+
+if __name__ == '__main__':
+    main()
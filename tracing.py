@@ -0,0 +1,198 @@
+"""Sampled span tracing of requests
+
+A traced request records a span for every datastore and memcache RPC
+(through apiproxy hooks), for every template rendering and for the model
+methods marked with @traced. Handler.dispatch() starts and finishes the
+trace, so a span tree shows where the time of a slow request went.
+
+Requests are traced with the probability TRACE_SAMPLE_RATE, set by the
+environment variable of the same name in app.yaml. Admins can force the
+trace of a single request with the request header 'X-Trace: 1', the
+response then has the header 'X-Trace-Id'.
+
+A finished trace is logged as JSON lines, one line per span, in the
+Trace Event Format (complete events, 'ph': 'X'). Put the lines of a
+trace into a JSON array to load it in chrome://tracing or Perfetto.
+Untraced requests only pay a thread-local lookup per span.
+
+Classes:
+Trace -- The spans of one request.
+
+Functions:
+install -- Add the apiproxy hooks.
+start -- Start the trace of a request if it is sampled.
+finish -- Finish and log the trace of the current request.
+span -- Return a context manager that records a span.
+traced -- Decorator that records a span for every call of a function.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import functools
+import threading
+
+from google.appengine.api import users
+from google.appengine.api import apiproxy_stub_map
+
+
+# Probability that a request is traced.
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+
+# Request header that forces a trace.
+TRACE_HEADER = 'X-Trace'
+
+# Trace of the current request of the thread.
+_current = threading.local()
+
+
+class Trace(object):
+    """The spans of one request
+
+    Methods:
+    add -- Add a finished span.
+    lines -- Return the spans as JSON lines.
+    """
+
+    def __init__(self, name):
+        self.id = random.getrandbits(48)
+        self.name = name
+        self.start = time.time()
+        self.events = []
+        # Start times of the running RPCs, by id of the RPC object.
+        self.rpcs = {}
+
+    def add(self, name, category, start, end, args = None):
+        event = {'name': name,
+                 'cat': category,
+                 'ph': 'X',
+                 'ts': int(start * 1000000),
+                 'dur': int((end - start) * 1000000),
+                 'pid': 1,
+                 'tid': self.id}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def lines(self):
+        return [json.dumps(event, sort_keys = True)
+                for event in sorted(self.events, key = lambda e: e['ts'])]
+
+
+class _Span(object):
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.trace.add(self.name, self.category, self.start, time.time(),
+                       self.args)
+        return False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, category = 'app', **args):
+    """Return a context manager that records a span of the current trace.
+
+    Arguments:
+    name -- name of the span
+    category -- category of the span, e.g. 'app', 'render', 'rpc'
+    args -- additional values shown with the span
+    """
+    trace = getattr(_current, 'trace', None)
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, category, args)
+
+
+def traced(name):
+    """Decorator that records a span for every call of a function.
+
+    Put it below @classmethod.
+    Argument:
+    name -- name of the span, e.g. 'Article.by_id'
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*a, **kw):
+            trace = getattr(_current, 'trace', None)
+            if trace is None:
+                return function(*a, **kw)
+            with _Span(trace, name, 'app', None):
+                return function(*a, **kw)
+        return wrapper
+    return decorator
+
+
+def start(request):
+    """Start the trace of a request if it is sampled or forced.
+
+    Argument:
+    request -- the webapp2 Request
+    Return value:
+    the Trace, None if the request is not traced
+    """
+    forced = (request.headers.get(TRACE_HEADER) == '1' and
+              users.is_current_user_admin())
+    if not forced and random.random() >= TRACE_SAMPLE_RATE:
+        _current.trace = None
+        return None
+    _current.trace = Trace('%s %s' % (request.method, request.path))
+    return _current.trace
+
+
+def finish(status):
+    """Finish and log the trace of the current request.
+
+    Argument:
+    status -- HTTP status of the response
+    """
+    trace = getattr(_current, 'trace', None)
+    if trace is None:
+        return
+    _current.trace = None
+    trace.add(trace.name, 'request', trace.start, time.time(),
+              {'status': status})
+    logging.info('Trace %d\n%s' % (trace.id, '\n'.join(trace.lines())))
+
+
+def _pre_call_hook(service, call, request, response, rpc):
+    trace = getattr(_current, 'trace', None)
+    if trace is not None:
+        trace.rpcs[id(rpc)] = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc):
+    trace = getattr(_current, 'trace', None)
+    if trace is None:
+        return
+    start = trace.rpcs.pop(id(rpc), None)
+    if start is not None:
+        trace.add('%s.%s' % (service, call), 'rpc', start, time.time())
+
+
+def install():
+    """Add the apiproxy hooks that record the datastore and memcache RPCs."""
+    for service in ('datastore_v3', 'memcache'):
+        # The hook keys must be unique per module.
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'tracing.' + service, _pre_call_hook, service)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'tracing.' + service, _post_call_hook, service)
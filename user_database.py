@@ -4,14 +4,47 @@ Classes:
 User -- Model for the User-Objects
 ResetPasswordRequest -- Model for reset-pasword requests 
 DeactAccounts --  Model for storing deleted user-accounts
+AccountDeletion -- Model for the progress of deleting the articles of an
+account
+Username -- Uniqueness index of the usernames
+Email -- Uniqueness index of the emails
+UserIndexBackfill -- Marker of the finished backfill of the index
 """
 
+import hashlib
 import logging
+import datetime
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 
 from utils import *
+from cache import CacheNamespace
+from tracing import traced
+
+
+# Increase the version after changing the model to orphan the cached
+# User-objects of the old version.
+USER_CACHE = CacheNamespace('User', 2, local_size = 1000, local_ttl = 60)
+
+# Session version of every user, see User.session_version_by_id().
+# The LocalCache saves the memcache round trip of Handler.initialize().
+SESSION_CACHE = CacheNamespace('session', 1, local_size = 1000, 
+                               local_ttl = 60)
+
+# User-id of every normalized username and email, see Username and Email.
+USER_INDEX_CACHE = CacheNamespace('UserIndex', 1)
+
+# Time a reset link is valid, expired requests are deleted by
+# tasks.expire_entities().
+RESET_REQUEST_LIFETIME = datetime.timedelta(hours = 1)
+
+# Seconds an instance trusts that the backfill of the user index has not
+# finished yet, see UserIndexBackfill.is_done().
+USER_INDEX_BACKFILL_CHECK_TIME = 60
+
+# True once this instance has seen the finished backfill.
+_user_index_backfilled = [False]
 
 
 class User(db.Model):
@@ -19,10 +52,15 @@ class User(db.Model):
 
     Methods:
     by_id -- Return a User-object for a given User-id.
+    by_ids -- Return a dictionary of User-objects for a list of User-ids.
     update_user_cache -- Store a User-object in memcache.
+    session_version_by_id -- Return the session version for a User-id.
+    new_session_version -- Increment the session version of a User-object.
+    by_index -- Return a User-object for a given username or email.
     by_email -- Return a User-object for a given email.
     by_name -- Return a User-object for a given user-name.
     register -- Return a new User-object to store in the datastore.
+    save -- Store a User-object and its Username- and Email-objects.
     login_by_email -- Return a User-object after successful authentication.
     remove -- Delete a User-object from the datastore.
     """
@@ -31,9 +69,12 @@ class User(db.Model):
     pw_hash = db.StringProperty(required = True)
     email = db.StringProperty(required = True)
     created = db.DateTimeProperty(auto_now_add=True)
+    # Sessions with another version are rejected, see Handler.read_session
+    session_version = db.IntegerProperty(default = 0)
 
 
     @classmethod
+    @traced('User.by_id')
     def by_id(cls, uid):
         """Return a User-object for a given User-id.
 
@@ -46,12 +87,42 @@ class User(db.Model):
         user -- the User-object for the given User-id, None if not found
         """
 
-        user = memcache.get(str(uid))
+        user = USER_CACHE.get(uid)
         if user is None:
             user = User.get_by_id(int(uid))
-            memcache.set(str(uid), user)
+            USER_CACHE.set(uid, user)
         return user
 
+    @classmethod
+    @traced('User.by_ids')
+    def by_ids(cls, uids):
+        """Return a dictionary of User-objects for a list of User-ids.
+
+        Read all users with a single memcache multi-get. The users that 
+        are not stored in memcache are fetched with a single batched 
+        Datastore get and written back to memcache in bulk.
+        Argument:
+        uids -- list of User-ids, duplicates are allowed
+        Return value:
+        users -- dictionary {User-id: User-object}, ids that are not found
+        are left out
+        """
+
+        uids = list(set(int(uid) for uid in uids))
+        cached = USER_CACHE.get_multi(uids)
+        missing = [uid for uid in uids if cached.get(uid) is None]
+        if missing:
+            fetched = User.get_by_id(missing)
+            fill = {}
+            for uid, user in zip(missing, fetched):
+                if user is not None:
+                    cached[uid] = user
+                    fill[uid] = user
+            if fill:
+                USER_CACHE.set_multi(fill)
+        return dict((uid, user) for uid, user in cached.iteritems()
+                    if user is not None)
+
     @classmethod
     def update_user_cache(cls, user):
         """Store a User-object in memcache.
@@ -61,38 +132,99 @@ class User(db.Model):
         user -- the User-object to be stored in memcache
         """
 
-        key = str(user.key().id())
-        memcache.set(key, user)
+        USER_CACHE.update(user.key().id(), user)
+        SESSION_CACHE.update(user.key().id(), user.session_version)
+
+    @classmethod
+    def session_version_by_id(cls, uid):
+        """Return the session version for a given User-id.
+
+        Read from the session cache, so the User-object is only loaded
+        if the version is not cached.
+        Argument:
+        uid -- the User-id
+        Return value:
+        the session version [integer], None if the user does not exist
+        """
+
+        version = SESSION_CACHE.get(uid)
+        if version is None:
+            user = cls.by_id(uid)
+            if user:
+                version = user.session_version
+                SESSION_CACHE.set(uid, version)
+        return version
+
+    @classmethod
+    def new_session_version(cls, user):
+        """Increment the session version of a User-object.
+
+        All sessions of the user become invalid after the User-object is 
+        stored and update_user_cache() is called. 
+        Call this whenever password, email or username change.
+        Argument:
+        user -- the User-object
+        """
+
+        user.session_version = (user.session_version or 0) + 1
+
+    @classmethod
+    @traced('User.by_index')
+    def by_index(cls, index, value):
+        """Return a User-object for a given username or email.
+
+        Read the User-id from the Username- or Email-object, which is
+        cached, then the User-object by id. Without the memcache both
+        are strongly consistent key lookups.
+        Arguments:
+        index -- the index model, Username or Email
+        value -- the username or email
+        Return value:
+        u -- the User-object, None if not found
+        """
+
+        cache_key = index.cache_key(value)
+        uid = USER_INDEX_CACHE.get(cache_key)
+        if uid is not None:
+            u = cls.by_id(uid)
+            # The cached id is outdated if the value changed since.
+            if u and index.normalize(index.value_of(u)) == \
+                     index.normalize(value):
+                return u
+        entry = index.get(index.key_for(value))
+        if entry:
+            USER_INDEX_CACHE.set(cache_key, entry.uid)
+            return cls.by_id(entry.uid)
+        if not UserIndexBackfill.is_done():
+            # Users stored before the index existed.
+            return User.all().filter(index.property_name, value).get()
 
     @classmethod
     def by_email(cls, email):
         """Return a User-object for a given email.
 
-        Execute a Datastore query and filter by the given email.
-        Return the first entity found. (emails should be unique)
+        Look up the Email-object by key, see by_index().
         Argument:
         email -- the email associated with a user-account
         Return value:
         u -- the User-object for the given email, None if not found
         """
 
-        u = User.all().filter('email', email).get()
-        return u
+        return cls.by_index(Email, email)
 
     @classmethod
     def by_name(cls, name):
         """Return a User-object for a given user-name.
 
-        Execute a Datastore query and filter by the given user-name.
-        Return the first entity found. (user-names should be unique)
+        Look up the Username-object by key, see by_index(). 
+        Usernames are compared case-insensitively.
         Argument:
         name -- the user-name associated with a user-account
         Return value:
         u -- the User-object for the given user-name, None if not found
         """
 
-        u = User.all().filter('name', name). get()
-        return u
+        return cls.by_index(Username, name)
 
     @classmethod
     def register(cls, name, pw, email):
@@ -120,6 +252,8 @@ class User(db.Model):
     def login_by_email(cls, email, pw):
         """Return a User-object after successful authentication.
 
+        If the password hash was created with an old hasher or old 
+        parameters, replace it with a new hash of the password.
         Arguments:
         email -- a unique email [string]
         pw -- a password [string]
@@ -129,23 +263,195 @@ class User(db.Model):
 
         u = cls.by_email(email)
         if u and valid_pw(email, pw, u.pw_hash):
+            if pw_needs_rehash(u.pw_hash):
+                u.pw_hash = make_pw_hash(email, pw)
+                u.put()
+                cls.update_user_cache(u)
             return u
     
+    @classmethod
+    def save(cls, user, old_name = None, old_email = None):
+        """Store a User-object and its Username- and Email-objects.
+
+        Use this instead of put() for new users and when the username or 
+        the email changes. In one cross-group transaction: check that 
+        a new username or email is not taken by another user, store the 
+        User-object, store the new Username- and Email-objects and delete 
+        the old ones. Then update memcache.
+        Index entities of other users are never changed: the backfill of
+        the index leaves a value that was used by two users (before the
+        index was case-insensitive) with the first user, the second user 
+        keeps it without an index entity.
+        Arguments:
+        user -- the User-object
+        old_name -- the username before a rename, None if unchanged
+        old_email -- the email before a change, None if unchanged
+        Return value:
+        None if the user was stored, 'name' or 'email' if the username or
+        the email is taken by another user.
+        """
+
+        new_user = not user.is_saved()
+        indexes = ((Username, 'name', old_name), 
+                   (Email, 'email', old_email))
+
+        def txn():
+            keys = [index.key_for(index.value_of(user)) 
+                    for index, field, old_value in indexes]
+            uid = None if new_user else user.key().id()
+            new_keys = []
+            for (index, field, old_value), key, entry in zip(indexes, keys,
+                                                             db.get(keys)):
+                if entry is None:
+                    new_keys.append((index, key))
+                elif entry.uid != uid and (new_user or old_value):
+                    return field
+            user.put()
+            uid = user.key().id()
+            old_keys = [index.key_for(old_value) 
+                        for index, field, old_value in indexes
+                        if old_value and index.normalize(old_value) != 
+                                         index.normalize(index.value_of(user))]
+            # Only delete the old entries that belong to this user.
+            old_keys = [entry.key() for entry in db.get(old_keys)
+                        if entry and entry.uid == uid]
+            if new_keys:
+                db.put([index(key = key, uid = uid) 
+                        for index, key in new_keys])
+            if old_keys:
+                db.delete(old_keys)
+
+        taken = db.run_in_transaction_options(
+            db.create_transaction_options(xg = True), txn)
+        if taken:
+            return taken
+
+        # Update memcache
+        cls.update_user_cache(user)
+        for index, field, old_value in indexes:
+            if old_value:
+                USER_INDEX_CACHE.delete(index.cache_key(old_value))
+            if new_user or old_value:
+                USER_INDEX_CACHE.set(index.cache_key(index.value_of(user)), 
+                                     user.key().id())
+
     @classmethod
     def remove(cls, user_id):
         """Delete a User-object from the datastore.
 
-        Delete user-object from datastore and memcache.
+        Delete user-object and its Username- and Email-objects from 
+        datastore and memcache in one cross-group transaction.
+        Username- and Email-objects of other users with the same 
+        normalized value are kept.
 
         Argument:
         user_id -- User-id
         """
-        user = User.by_id(int(user_id))
-        db.delete(user)
 
-        key = str(user_id)
-        memcache.delete(key)
+        def txn():
+            user = User.get_by_id(int(user_id))
+            if user:
+                entries = db.get([Username.key_for(user.name),
+                                  Email.key_for(user.email)])
+                db.delete([user] + 
+                          [entry for entry in entries 
+                           if entry and entry.uid == user.key().id()])
+            return user
 
+        user = db.run_in_transaction_options(
+            db.create_transaction_options(xg = True), txn)
+
+        USER_CACHE.delete(user_id)
+        SESSION_CACHE.delete(user_id)
+        if user:
+            USER_INDEX_CACHE.delete_multi([Username.cache_key(user.name),
+                                           Email.cache_key(user.email)])
+
+
+class UserIndex(db.Model):
+    """Base class of the uniqueness indexes Username and Email
+
+    The key name is the normalized value, so a value can only belong to
+    one user and a lookup is a key get.
+    Methods:
+    normalize -- Return the normalized value.
+    key_for -- Return the key of the index entity of a value.
+    cache_key -- Return the memcache key of a value.
+    value_of -- Return the indexed value of a User-object.
+    """
+
+    uid = db.IntegerProperty(required = True, indexed = False)
+    # Name of the indexed property of User, set by the subclasses.
+    property_name = None
+
+    @classmethod
+    def normalize(cls, value):
+        return value.strip().lower()
+
+    @classmethod
+    def key_for(cls, value):
+        return db.Key.from_path(cls.kind(), cls.normalize(value))
+
+    @classmethod
+    def cache_key(cls, value):
+        # Emails can be longer than a memcache key and are not ASCII.
+        return '%s:%s' % (cls.kind(), hashlib.md5(
+            cls.normalize(value).encode('utf-8')).hexdigest())
+
+    @classmethod
+    def value_of(cls, user):
+        return getattr(user, cls.property_name)
+
+
+class Username(UserIndex):
+    """Uniqueness index of the usernames, case-insensitive"""
+
+    property_name = 'name'
+
+
+class Email(UserIndex):
+    """Uniqueness index of the emails"""
+
+    property_name = 'email'
+
+
+class UserIndexBackfill(db.Model):
+    """Marker that tasks.backfill_user_index has finished
+
+    Until then User.by_index() looks up users without a Username- or 
+    Email-object by query. There is at most one entity, key name 'done'.
+    Methods:
+    is_done -- Check if the backfill has finished.
+    mark_done -- Store the marker.
+    """
+
+    finished = db.DateTimeProperty(auto_now_add = True)
+
+    @classmethod
+    def is_done(cls):
+        """Check if the backfill of the user index has finished.
+
+        Once True, the answer is kept in the memory of the instance. 
+        Until then it is cached in memcache for 
+        USER_INDEX_BACKFILL_CHECK_TIME seconds.
+        """
+
+        if _user_index_backfilled[0]:
+            return True
+        done = USER_INDEX_CACHE.get('backfill_done')
+        if done is None:
+            done = cls.get_by_key_name('done') is not None
+            USER_INDEX_CACHE.set('backfill_done', done, 
+                                 0 if done else USER_INDEX_BACKFILL_CHECK_TIME)
+        _user_index_backfilled[0] = done
+        return done
+
+    @classmethod
+    def mark_done(cls):
+        """Store the marker and end the fallback queries of all instances."""
+
+        cls(key_name = 'done').put()
+        USER_INDEX_CACHE.set('backfill_done', True)
 
 
 class ResetPasswordRequest(db.Model):
@@ -153,10 +459,11 @@ class ResetPasswordRequest(db.Model):
 
     Methods:
     create_request -- Return a new ResetPasswordRequest-object.
-    by_email -- Return most recent ResetPasswordRequest-object for given email.
+    remove_for_email -- Delete all ResetPasswordRequest-objects of an email.
     by_id -- Return the ResetPasswordRequest-object for a given request-id.
     check_for_valid_request -- Return ResetPasswordRequest-object 
     after successful authentication.
+    expired -- Check if the request is older than RESET_REQUEST_LIFETIME.
     """
 
     email = db.StringProperty(required = True)
@@ -187,18 +494,24 @@ class ResetPasswordRequest(db.Model):
                     temp_pw_hash = temp_pw_hash)
 
     @classmethod
-    def by_email(cls, email):
-        """Return most recent ResetPasswordRequest-object for a given email.
+    def remove_for_email(cls, emails, request):
+        """Delete all ResetPasswordRequest-objects of an email.
 
-        Argument:
-        email -- user email
-        Return value:
-        r -- the most recent ResetPasswordRequest-object
+        Called after a successful reset, so no other reset link of the
+        user stays valid. The requests are deleted with one batched delete.
+        The keys-only query is eventually consistent, the used request is
+        deleted by its key in any case.
+        Arguments:
+        emails -- the emails of the user, as stored and as typed in the
+        request [list of strings]
+        request -- the used ResetPasswordRequest-object
         """
 
-        r = ResetPasswordRequest.all().filter('email', email)\
-            .order('-created').get()
-        return r
+        keys = set([request.key()])
+        for email in set(emails):
+            keys.update(ResetPasswordRequest.all(keys_only = True)
+                        .filter('email', email).fetch(None))
+        db.delete(list(keys))
 
     @classmethod
     def by_id(cls, rid):
@@ -213,19 +526,23 @@ class ResetPasswordRequest(db.Model):
         return ResetPasswordRequest.get_by_id(int(rid))
 
     @classmethod
-    def check_for_valid_request(cls, email, temp_pw):
+    def check_for_valid_request(cls, request, temp_pw):
         """Return ResetPasswordRequest-object after successful authentication.
 
+        Check the temporary password against the request fetched by id,
+        without another query.
         Arguments:
-        email -- the user email [string]
+        request -- the ResetPasswordRequest-object, see by_id()
         temp_pw -- the temporary password [string]
         Return value:
-        r -- the ResetPasswordRequest-object
+        r -- the ResetPasswordRequest-object, None if not valid
         """
 
-        r = cls.by_email(email)
-        if r and valid_pw(email, temp_pw, r.temp_pw_hash):
-            return r
+        if request and valid_pw(request.email, temp_pw, request.temp_pw_hash):
+            return request
+
+    def expired(self):
+        return datetime.datetime.now() - RESET_REQUEST_LIFETIME > self.created
 
 
 class DeactAccounts(db.Model):
@@ -260,3 +577,48 @@ class DeactAccounts(db.Model):
 
         return DeactAccounts(uid = uid, name = name, email = email)
 
+
+
+class AccountDeletion(db.Model):
+    """Datastore model for the AccountDeletion-Objects.
+
+    Track the progress of the background task that archives and deletes 
+    the articles of a deleted account (see tasks.delete_author_articles).
+    The key name is the User-id.
+
+    Methods:
+    start -- Return a new AccountDeletion-object.
+    by_uid -- Return the AccountDeletion-object for a given User-id.
+    """
+
+    uid = db.IntegerProperty(required = True)
+    cursor = db.StringProperty(indexed = False)
+    articles_deleted = db.IntegerProperty(default = 0, indexed = False)
+    done = db.BooleanProperty(default = False)
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+
+    @classmethod
+    def start(cls, uid):
+        """Return a new AccountDeletion-object.
+
+        Arguments:
+        uid -- user-id [integer]
+        Return value:
+        the new AccountDeletion-object
+        """
+
+        return AccountDeletion(key_name = str(uid), uid = int(uid))
+
+    @classmethod
+    def by_uid(cls, uid):
+        """Return the AccountDeletion-object for a given User-id.
+
+        Argument:
+        uid -- user-id
+        Return value:
+        the AccountDeletion-object, None if not found
+        """
+
+        return AccountDeletion.get_by_key_name(str(uid))
@@ -9,11 +9,14 @@ from string import ascii_letters
 import logging
 
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 
 from utils import *
 from handler import Handler
-from user_database import User, ResetPasswordRequest, DeactAccounts
+from user_database import User, ResetPasswordRequest, DeactAccounts,\
+                          AccountDeletion, Email
 from article_database import Article, DeletdArticle
+from tasks import rename_author, defer_delete_author_articles
 
 # --- USER SIGNUP - LOGNIN - LOGOUT ---
 
@@ -90,6 +93,18 @@ class SignupHandler(Handler):
                     error_user_exists = True
                     have_error = True
 
+            if have_error == False:
+                #Create new entry in the User-DB, username and email
+                #are checked again in the transaction.
+                u = User.register(input_username, input_password, input_email)
+                taken = User.save(u)
+                if taken == 'name':
+                    error_username_exists = True
+                    have_error = True
+                elif taken == 'email':
+                    error_user_exists = True
+                    have_error = True
+
             if have_error:
                 state = self.make_state()
                 # Render page with error-messages.
@@ -106,12 +121,6 @@ class SignupHandler(Handler):
                             verify_email_form = input_verify_email,
                             state = state)
             else:
-                #Create new entry in the User-DB.
-                u = User.register(input_username, input_password, input_email)
-                u.put()
-                #update memcache
-                User.update_user_cache(u)
-
                 #Send confirmation email
                 self.send_email(u.email, 
                                 'email_subject.html', 
@@ -138,6 +147,10 @@ class LoginHandler(Handler):
             self.render('login.html', state = state)
 
     def post(self):
+        # Reject floods before the password is hashed.
+        if self.rate_limited('login', 
+                             email = self.request.get('email')):
+            return
         if self.user:
             # Prompt user to log out.
             self.render('message.html', 
@@ -170,12 +183,12 @@ class LoginHandler(Handler):
 class LogoutHandler(Handler):
 
     def get(self):
-        if self.user:
+        if self.claims:
             self.logout()
             # Show message that user has been logged out.
             self.render('message.html', 
                         message_logout_1 = True,
-                        logout_name = self.user.name)
+                        logout_name = self.claims.name)
         else:
             self.redirect("/")
 
@@ -195,6 +208,10 @@ class ForgotPasswordHandler(Handler):
             self.render('forgot_password.html', state = state)
 
     def post(self):
+        # Reject floods before the user is looked up and the email is sent.
+        if self.rate_limited('forgot_password', 
+                             email = self.request.get('email')):
+            return
         if self.user:
             # Prompt user to log out.
             self.render('message.html', 
@@ -259,8 +276,7 @@ class ResetPasswordHandler(Handler):
             input_token = self.request.get('token')
 
             # Check if format of token is valid 
-            TOKEN_RE = re.compile(r"^([0-9]{1,30})\-.{3,20}$")
-            if not TOKEN_RE.match(input_token):
+            if not valid_reset_token(input_token):
                 # Set invalid reset_id so that a normal error message is sent
                 reset_id = 1
             else:
@@ -276,12 +292,12 @@ class ResetPasswordHandler(Handler):
                 self.render('message.html', message_reset_password_2 = True)
 
             # Check if entry is not older than one hour.
-            elif datetime.datetime.now() - datetime.timedelta(hours = 1) > self.p.created:
+            elif self.p.expired():
                 # Show message that too much time has passed.
                 self.render('message.html', message_reset_password_3 = True)
 
             # Check if temp_pw is valid
-            elif not ResetPasswordRequest.check_for_valid_request(self.p.email, temp_pw):
+            elif not ResetPasswordRequest.check_for_valid_request(self.p, temp_pw):
                 # Show message that the link is not valid.
                 self.render('message.html', message_reset_password_4 = True)
 
@@ -311,8 +327,7 @@ class ResetPasswordHandler(Handler):
             input_token = self.request.get('token')
 
             # Check if token is valid
-            TOKEN_RE = re.compile(r"^([0-9]{1,30})\-.{3,20}$")
-            if not TOKEN_RE.match(input_token):
+            if not valid_reset_token(input_token):
                 # Set invalid reset_id so that a normal error message is sent
                 reset_id = 1
             else:
@@ -329,14 +344,17 @@ class ResetPasswordHandler(Handler):
                             message_reset_password_5 = True)
 
             #Check if entry is not older than one hour.
-            elif datetime.datetime.now() - datetime.timedelta(hours = 1) > self.p.created:
+            elif self.p.expired():
                 # Show message that too much time has passed.
                 self.render('message.html', 
                             user = self.user, 
                             message_reset_password_3 = True)
 
-            #Check if temp_pw is valid
-            elif not ResetPasswordRequest.check_for_valid_request(self.p.email, temp_pw):
+            #Check if temp_pw is valid and the request is for this user
+            elif (not ResetPasswordRequest.check_for_valid_request(self.p, 
+                                                                   temp_pw)
+                  or Email.normalize(self.p.email) != 
+                     Email.normalize(self.user.email)):
                 # Show message to contact via email
                 self.render('message.html', 
                             user = self.user, 
@@ -371,14 +389,17 @@ class ResetPasswordHandler(Handler):
                     # Generate password-hash and store in DB
                     pw_hash = make_pw_hash(self.user.email, input_password)
                     self.user.pw_hash = pw_hash
+                    # Invalidate all other sessions of the user
+                    User.new_session_version(self.user)
                     self.user.put()
                     # Update memcache
                     User.update_user_cache(self.user)
+                    # Keep the current session valid
+                    self.login(self.user)
 
-                    # Invalidate entity in ResetPasswordRequest db
-                    self.p = ResetPasswordRequest.by_email(self.user.email)
-                    self.p.temp_pw_hash = "deactivated"
-                    self.p.put()
+                    # Invalidate this and all other reset links of the user
+                    ResetPasswordRequest.remove_for_email(
+                        [self.p.email, self.user.email], self.p)
 
                     # Show message that the password has been changed.
                     self.render('message.html', 
@@ -463,9 +484,13 @@ class ChangePasswordHandler(Handler):
                 # Generate password-hash and store in DB
                 pw_hash = make_pw_hash(self.user.email, input_password)
                 self.user.pw_hash = pw_hash
+                # Invalidate all other sessions of the user
+                User.new_session_version(self.user)
                 self.user.put()
                 # Update memcache
                 User.update_user_cache(self.user)
+                # Keep the current session valid
+                self.login(self.user)
 
                 state = self.make_state()
                 # Render page with success message.
@@ -531,6 +556,22 @@ class ChangeEmailHandler(Handler):
                     # Set the error-message: email already assigned.
                     error_user_exists = True
                     have_error = True
+
+            if have_error == False:
+                # Generate password-hash
+                # Store new email and password-hash in DB, the email is 
+                # checked again in the transaction.
+                old_email = self.user.email
+                self.user.pw_hash = make_pw_hash(input_email, 
+                                                 input_current_password)
+                self.user.email = input_email
+                # Invalidate all other sessions of the user
+                User.new_session_version(self.user)
+                # Store and update memcache
+                if User.save(self.user, old_email = old_email):
+                    self.user = User.by_id(self.user.key().id())
+                    error_user_exists = True
+                    have_error = True
  
             if have_error:
                 state = self.make_state()
@@ -544,14 +585,8 @@ class ChangeEmailHandler(Handler):
                             error_user_exists = error_user_exists,
                             state = state)
             else:
-                # Generate password-hash
-                # Store new email and password-hash in DB
-                pw_hash = make_pw_hash(input_email, input_current_password)
-                self.user.pw_hash = pw_hash
-                self.user.email = input_email
-                self.user.put()
-                # Update memcache
-                User.update_user_cache(self.user)
+                # Keep the current session valid
+                self.login(self.user)
 
                 # Send email notification to new address
                 self.send_email(self.user.email, 
@@ -608,10 +643,24 @@ class ChangeUsernameHandler(Handler):
 
             if have_error == False:
                 u = User.by_name(input_username)
-                if u:
+                # A change of the case only finds the user itself.
+                if u and u.key().id() != self.user.key().id():
                     # Set the error-message: username already taken.
                     error_username_exists = True
                     have_error = True
+
+            if have_error == False:
+                # Store new username in DB, it is checked again in the
+                # transaction.
+                old_name = self.user.name
+                self.user.name = input_username
+                # Invalidate all other sessions of the user
+                User.new_session_version(self.user)
+                # Store and update memcache
+                if User.save(self.user, old_name = old_name):
+                    self.user = User.by_id(self.user.key().id())
+                    error_username_exists = True
+                    have_error = True
  
             if have_error:
                 state = self.make_state()
@@ -623,11 +672,11 @@ class ChangeUsernameHandler(Handler):
                             error_username_exists = error_username_exists,
                             state = state)
             else:
-                # Store new username in DB
-                self.user.name = input_username
-                self.user.put()
-                # Update memcache
-                User.update_user_cache(self.user)
+                # Keep the current session valid, with the new username
+                self.login(self.user)
+                # Update the author name on the user's articles
+                # in the background.
+                deferred.defer(rename_author, self.user.key().id())
 
                 # Render page success message
                 state = self.make_state()
@@ -692,18 +741,11 @@ class DeleteAccountHandler(Handler):
                 # Delete user
                 User.remove(self.user.key().id())
 
-                # Genrate list of article-keys for the deleted user.
-                article_key_list = Article.keys_by_author(self.user.key().id())
-
-                for key in article_key_list:
-                    # Store article in DeletdArticle DB
-                    article = Article.by_id(key.id())
-                    del_art = DeletdArticle.create(article.title,
-                                                   article.body, 
-                                                   article.author)
-                    del_art.put()
-                    # Delete article from Article DB
-                    Article.remove(key.id())
+                # Store the articles of the deleted user in the 
+                # DeletdArticle DB and delete them in the background.
+                job = AccountDeletion.start(self.user.key().id())
+                job.put()
+                defer_delete_author_articles(job)
                 
                 # Logout (delete coockie)
                 self.logout()
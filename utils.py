@@ -6,6 +6,10 @@ import hashlib
 import hmac
 from string import ascii_letters
 
+import password_hashing
+from validation import USERNAME, PASSWORD, EMAIL, TITLE, BODY, SUBJECT,\
+                       CONTENT, RESET_TOKEN
+
 
 # --- HASH COOKIES ---
 
@@ -25,37 +29,35 @@ def check_secure_val(secure_val):
 
 # --- VERIFY USER INPUT ---
 
-USER_RE = re.compile(r"^[a-zA-Z0-9_-]{3,20}$")
+# The schemas of the fields are defined in the validation module.
+
 def valid_username(username):
-    return USER_RE.match(username)
+    return USERNAME.valid(username)
 
-PASS_RE = re.compile(r"^(?=.*?\d)(?=.*?[A-Z])(?=.*?[a-z])[A-Za-z0-9_-]{8,20}$")
 def valid_password(password):
-    return PASS_RE.match(password)
+    return PASSWORD.valid(password)
 
-EMAIL_RE = re.compile(r"^[\S]+@[\S]+\.[\S]+$")
 def valid_email(email):
-    return EMAIL_RE.match(email)
+    return EMAIL.valid(email)
 
 def valid_verify(value, verify):
     if value==verify:
         return True
 
-TITLE_RE = re.compile(r"^.{1,78}$")
 def valid_title(title):
-    return TITLE_RE.match(title)
+    return TITLE.valid(title)
 
-BODY_RE = re.compile(r"^(.|\n){1,20000}$")
 def valid_body(body):
-    return BODY_RE.match(body)
+    return BODY.valid(body)
 
-SUBJECT_RE = re.compile(r"^.{1,78}$")
 def valid_subject(subject):
-    return SUBJECT_RE.match(subject)
+    return SUBJECT.valid(subject)
 
-CONTENT_RE = re.compile(r"^(.|\n){1,1000}$")
 def valid_content(content):
-    return CONTENT_RE.match(content)
+    return CONTENT.valid(content)
+
+def valid_reset_token(token):
+    return RESET_TOKEN.valid(token)
 
 
 # --- HASH AND SALT PASSWORDS ---
@@ -64,17 +66,26 @@ def valid_content(content):
 # verify login_name and pw from login.
 # Login_name can be username, email or similar. 
 # Used by the decorator methods register and login.
+# The hashing itself is done by the password_hashing module.
 def make_salt(length = 10):
     return ''.join(random.choice(ascii_letters)for x in xrange(length))
 
-def make_pw_hash(login_name, pw, salt = None):
-    if not salt:
-        salt = make_salt()
-    h = hashlib.sha256(login_name + pw + salt).hexdigest()
-    return '%s,%s' % (salt, h)
+def make_pw_hash(login_name, pw):
+    return password_hashing.make_hash(login_name, pw)
 
 def valid_pw(login_name, password, pw_hash):
-    salt = pw_hash.split(',')[0]
-    return pw_hash == make_pw_hash(login_name, password, salt)
-    #pw_hash is safed in the database. pw_hash = "salt,hash_value".  
+    return password_hashing.verify(login_name, password, pw_hash)
+    #pw_hash is safed in the database. 
+    #pw_hash = "pbkdf2_sha256$iterations$salt$hash_value"
+    #or for old hashes: pw_hash = "salt,hash_value".
+
+def pw_needs_rehash(pw_hash):
+    return password_hashing.needs_rehash(pw_hash)
+
+
+# --- PRECOMPILED TEMPLATES ---
 
+# tools/compile_templates.py writes the Jinja2 version and the app version
+# into the manifest of the compiled templates. Handler loads the compiled
+# templates only if both match the running app.
+TEMPLATE_MANIFEST = 'manifest.json'
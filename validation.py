@@ -0,0 +1,95 @@
+"""Schemas of the user input fields
+
+Every field is checked in linear time: first the length, which is O(1),
+then the characters in a single pass. There are no regular expressions
+that can backtrack, so large inputs can not burn CPU.
+The schemas are compiled once at import and shared by all handlers
+through the valid_* functions of the utils module.
+See tools/bench_validation.py for a benchmark with worst-case inputs.
+
+Classes:
+Field -- Schema of a text input field.
+
+Fields:
+USERNAME, PASSWORD, EMAIL, TITLE, BODY, SUBJECT, CONTENT, RESET_TOKEN
+"""
+
+import re
+
+
+class Field(object):
+    """Schema of a text input field
+
+    Methods:
+    valid -- Return True if a value fits the schema.
+    """
+
+    def __init__(self, min_length, max_length, charset = None,
+                 multiline = False, check = None):
+        """Arguments:
+        min_length -- minimum number of characters
+        max_length -- maximum number of characters
+        charset -- regular expression of a single allowed character,
+        e.g. '[a-z]', None to allow all characters
+        multiline -- True to allow newlines
+        check -- function for additional checks, called with values that
+        passed all other checks, it must run in linear time
+        """
+        self.min_length = min_length
+        self.max_length = max_length
+        self.multiline = multiline
+        self.check = check
+        self.charset = None
+        if charset:
+            # A single character class with * can not backtrack.
+            self.charset = re.compile(r'%s*\Z' % charset)
+
+    def valid(self, value):
+        if value is None:
+            return False
+        if not self.min_length <= len(value) <= self.max_length:
+            return False
+        if not self.multiline and '\n' in value:
+            return False
+        if self.charset and not self.charset.match(value):
+            return False
+        if self.check and not self.check(value):
+            return False
+        return True
+
+
+_DIGIT_RE = re.compile(r'[0-9]')
+_UPPER_RE = re.compile(r'[A-Z]')
+_LOWER_RE = re.compile(r'[a-z]')
+_WHITESPACE_RE = re.compile(r'\s')
+
+def _check_password(value):
+    # At least one digit, one upper case and one lower case letter.
+    return bool(_DIGIT_RE.search(value) and _UPPER_RE.search(value) and
+                _LOWER_RE.search(value))
+
+def _check_email(value):
+    # Same as ^\S+@\S+\.\S+$: no whitespace, an '@' that is not the first
+    # character and a '.' that is at least two characters after it and
+    # not the last character.
+    if _WHITESPACE_RE.search(value):
+        return False
+    at = value.find('@', 1)
+    dot = value.rfind('.', 0, len(value) - 1)
+    return at != -1 and dot >= at + 2
+
+def _check_reset_token(value):
+    # Same as ^[0-9]{1,30}-.{3,20}$: request-id, '-', temporary password.
+    reset_id, sep, temp_pw = value.partition('-')
+    return (sep == '-' and 1 <= len(reset_id) <= 30 and
+            not reset_id.strip('0123456789') and 3 <= len(temp_pw) <= 20)
+
+
+USERNAME = Field(3, 20, charset = r'[a-zA-Z0-9_-]')
+PASSWORD = Field(8, 20, charset = r'[A-Za-z0-9_-]', check = _check_password)
+EMAIL = Field(5, 254, check = _check_email)
+TITLE = Field(1, 78)
+BODY = Field(1, 20000, multiline = True)
+SUBJECT = Field(1, 78)
+CONTENT = Field(1, 1000, multiline = True)
+RESET_TOKEN = Field(5, 51, check = _check_reset_token)